@@ -16,10 +16,41 @@
 # Default flags for bare-metal programming (without any framework layers)
 #
 
+import sys
+
 from SCons.Script import DefaultEnvironment
 
 env = DefaultEnvironment()
 
+# custom_opt_profile: (optimization flags, link time optimization)
+# -Os needs some patches: https://github.com/DragonMinded/libdragon/pull/669
+OPT_PROFILES = {
+    "speed": (["-O2", "-falign-functions=32"], False),
+    "size": (["-Os"], False),
+    "lto": (["-O2", "-falign-functions=32"], True),
+    "lto-size": (["-Os"], True),
+}
+
+opt_profile = str(env.GetProjectOption("custom_opt_profile", "speed")).strip().lower()
+if opt_profile not in OPT_PROFILES:
+    sys.stderr.write("Error: custom_opt_profile must be one of %s, not '%s'\n" % (
+        ", ".join(OPT_PROFILES), opt_profile))
+    env.Exit(1)
+opt_flags, use_lto = OPT_PROFILES[opt_profile]
+
+# With LTO, the code is generated at link time, so the optimization flags go there too.
+# The flags are only referenced through N64_LTO*FLAGS, so that DSOs (which are linked
+# with plain ld, without the LTO plugin) can turn them off. Assembly is never affected.
+# AR and RANLIB are the gcc-ar / gcc-ranlib wrappers, so archives get an LTO symbol index.
+# In debug builds PlatformIO strips -O* and adds debug_build_flags (also to LINKFLAGS),
+# so the link must not bring the profile's level back.
+debug_build = "debug" in env.GetBuildType()
+env.Replace(
+    N64_OPT_PROFILE=opt_profile,
+    N64_LTOFLAGS=["-flto"] if use_lto else [],
+    N64_LTOLINKFLAGS=(["-flto=auto"] + ([] if debug_build else opt_flags)) if use_lto else [],
+)
+
 env.Append(
     ASFLAGS=[
     ],
@@ -27,18 +58,20 @@ env.Append(
         "-x", "assembler-with-cpp",
     ],
 
-    # -Os needs some patches: https://github.com/DragonMinded/libdragon/pull/669
-    CCFLAGS=[
-        "-O2",  # optimize speed
+    CCFLAGS=opt_flags + [
         "-ffunction-sections",  # place each function in its own section
         "-fdata-sections",
-        "-falign-functions=32",
         "-Wall",
     ],
 
+    CFLAGS=[
+        "$N64_LTOFLAGS"
+    ],
+
     CXXFLAGS=[
         "-fno-rtti",
-        "-fno-exceptions"
+        "-fno-exceptions",
+        "$N64_LTOFLAGS"
     ],
 
     CPPDEFINES=[
@@ -46,7 +79,8 @@ env.Append(
     ],
 
     LINKFLAGS=[
-        "-Wl,--gc-sections"#,--relax",
+        "-Wl,--gc-sections",#,--relax",
+        "$N64_LTOLINKFLAGS"
     ],
 
     LIBS=["c", "gcc", "m", "stdc++"]
@@ -12,9 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os, re, sys
+import atexit, hashlib, json, os, re, sys
 from pathlib import Path
-from SCons.Script import DefaultEnvironment, Builder, AlwaysBuild
+import SCons.Node.FS
+import SCons.Scanner
+import SCons.Scanner.C
+from SCons.Script import DefaultEnvironment, Builder
+from n64.cache import get_build_cache
+from n64.elf import ElfFile, compare_blob_objects, write_blob_object
+from n64.modules import (close_modules, detect_modules, group_modules, load_module_index,
+                         module_of, scan_identifiers)
+from n64.options import get_bool_option, get_list_option
+from n64.sources import find_framework_sources, folders_signature
+from n64.trace import span
+from n64.unity import group_unity_sources, write_unity_source
 
 env = DefaultEnvironment()
 platform = env.PioPlatform()
@@ -50,10 +61,24 @@ if is_preview_branch:
 else:
     c_ver = "-std=gnu99"
 
+# custom_debug_level: how much debug info goes into every object.
+# n64sym / n64dso-msym only need symbols and line tables for backtraces, which all levels
+# have. Macro info (-g3) makes objects several times larger and slows compiles and links,
+# but is the default for compatibility. Debug builds (`pio debug`) replace all -g / -O
+# flags with debug_build_flags, so there the level comes from that option instead.
+DEBUG_LEVELS = {
+    "full": ["-g3", "-ggdb3"],  # all debug info, including macros
+    "lines": ["-g2"],  # types, variables and line tables, no macros
+    "minimal": ["-g1"],  # line tables and function symbols only
+}
+debug_level = str(env.GetProjectOption("custom_debug_level", "full")).strip().lower()
+if debug_level not in DEBUG_LEVELS:
+    sys.stderr.write("Error: custom_debug_level must be one of %s, not '%s'\n" % (
+        ", ".join(DEBUG_LEVELS), debug_level))
+    env.Exit(1)
+
 env.Append(
-    CCFLAGS=[
-        "-g3", # all debug symbols by default (needed for symbol generation)
-        "-ggdb3",
+    CCFLAGS=DEBUG_LEVELS[debug_level] + [
         "-ffast-math",
         "-ftrapping-math",
         "-fno-associative-math",
@@ -110,21 +135,90 @@ if not board.get("build.ldscript", ""):
 libs = []
 
 # Automatically find all libdragon source files, except the Audio library, which is special.
-# We need to ignore audio/opus/* there.
-libdragon_src_dir = Path(os.path.join(FRAMEWORK_DIR, "src"))
+# We need to ignore audio/opus/* there. The scan is remembered per framework revision.
+libdragon_sources_cache = os.path.join(env.subst("$PROJECT_CORE_DIR"), ".cache", "nintendon64", "libdragon-sources.json")
 libdragon_srcs = [
-        str(file.relative_to(libdragon_src_dir)) for file in libdragon_src_dir.rglob('*') 
-        if file.suffix in {'.c', '.cpp', '.S'} and 
-        not file.relative_to(libdragon_src_dir).parts[:2] == ('audio', 'opus') and 
-        file.name != 'debugcpp.cpp']
-
-# finally, we have to do a modification to build audio/libopus.c: Disable all warnings.
-def build_with_no_warnings(env, node):
-    return env.Object(
-        node,
-        CCFLAGS=env["CCFLAGS"] + ["-Wno-all", "-Wno-error"]
-    )
-env.AddBuildMiddleware(build_with_no_warnings, "**/audio/libopus.c")
+    src for src in find_framework_sources(
+        os.path.join(FRAMEWORK_DIR, "src"),
+        {".c", ".cpp", ".S"},
+        platform.get_package_version("framework-libdragon"),
+        libdragon_sources_cache)
+    if not src.startswith("audio/opus/") and os.path.basename(src) != "debugcpp.cpp"]
+
+# audio/libopus.c is built with all warnings disabled
+no_warnings_flags = ["-Wno-all", "-Wno-error"]
+
+#
+# Precompiled libdragon.h (custom_libdragon_pch = yes). One .gch for C and one for C++,
+# built with the same flags as the regular compiles (including -include ktls.h on preview).
+# It is force-included into every C / C++ file whose first directive is #include <libdragon.h>.
+# If the flags of a file differ (e.g. src_build_flags), gcc silently ignores the .gch and
+# parses the header as usual.
+#
+pch_enabled = get_bool_option(env, "custom_libdragon_pch")
+pch_languages = {
+    # file suffix -> (folder, compile command)
+    ".c": ("c", "$COMPILER_LAUNCHER $CC -x c-header -o $TARGET -c $CFLAGS $CCFLAGS $_CCCOMCOM $SOURCES $N64_DEPFLAGS"),
+    ".cpp": ("cxx", "$COMPILER_LAUNCHER $CXX -x c++-header -o $TARGET -c $CXXFLAGS $CCFLAGS $_CCCOMCOM $SOURCES $N64_DEPFLAGS"),
+    ".cc": ("cxx", None),
+    ".cxx": ("cxx", None),
+}
+pch_nodes = {}
+
+def includes_libdragon_first(path):
+    try:
+        with open(path, "r", errors="replace") as f:
+            text = f.read(16384)
+    except OSError:
+        return False
+    text = re.sub(r"/\*.*?\*/", "", text, flags=re.S)
+    text = re.sub(r"//[^\n]*", "", text)
+    for line in text.splitlines():
+        line = line.strip()
+        if line:
+            return re.match(r'#\s*include\s*[<"]libdragon\.h[>"]', line) is not None
+    return False
+
+def get_pch(kind):
+    """ (header to -include, .gch node) for "c" or "cxx", created on first use. """
+    if kind not in pch_nodes:
+        header = env.subst(os.path.join("$BUILD_DIR", "FrameworkLibdragonPCH", kind, "libdragon_pch.h"))
+        contents = "/* Generated by the nintendon64 platform (custom_libdragon_pch), do not edit. */\n" + \
+            "#include <libdragon.h>\n"
+        if not os.path.isfile(header) or Path(header).read_text() != contents:
+            os.makedirs(os.path.dirname(header), exist_ok=True)
+            Path(header).write_text(contents)
+        command = pch_languages[".c" if kind == "c" else ".cpp"][1]
+        gch = env.Command(
+            header + ".gch",
+            header,
+            env.VerboseAction(command, "Precompiling libdragon.h (%s)" % kind),
+            **({"target_scanner": env["N64_DEPFILE_SCANNER"]} if env.get("N64_DEPFILE_SCANNER")
+               else {"source_scanner": SCons.Scanner.C.CScanner()})
+        )
+        pch_nodes[kind] = (header, gch)
+    return pch_nodes[kind]
+
+def pch_for(path):
+    """ (header, .gch node) to force-include into the source file at path, or None. """
+    suffix = os.path.splitext(path)[1]
+    if not pch_enabled or suffix not in pch_languages or not includes_libdragon_first(path):
+        return None
+    return get_pch(pch_languages[suffix][0])
+
+# user sources get it through a middleware, framework sources in framework_object()
+def build_with_pch(env, node):
+    if not isinstance(node, SCons.Node.FS.File):
+        return node  # already turned into an object by another middleware
+    pch = pch_for(node.srcnode().get_abspath())
+    if pch is None:
+        return node
+    obj = env.Object(node, CCFLAGS=["-include", pch[0]] + env["CCFLAGS"])
+    env.Depends(obj, pch[1])
+    return obj
+
+if pch_enabled:
+    env.AddBuildMiddleware(build_with_pch, "*")
 
 # RSP assembly sources have to be built differently, filter them out at this stage
 def is_rsp_file(file: str) -> bool:
@@ -132,23 +226,119 @@ def is_rsp_file(file: str) -> bool:
 rsp_srcs = [x for x in libdragon_srcs if is_rsp_file(x)]
 libdragon_srcs = [x for x in libdragon_srcs if not is_rsp_file(x)]
 
-libs.append(
-   env.BuildLibrary(
-        os.path.join("$BUILD_DIR", "FrameworkLibdragon"),
-        os.path.join(FRAMEWORK_DIR, "src"),
-        "-<*> " + " ".join(["+<%s>" % src for src in libdragon_srcs])
-))
+#
+# libdragon is built as one archive per module (top-level folder of src/, files directly
+# in src/ are the "core" module). custom_libdragon_modules selects what gets built:
+# "all" (default), "auto" (detected from the project's sources) or a list of modules.
+# Modules that the selected ones depend on are always added.
+#
+def project_source_paths():
+    paths = [env.subst("$PROJECT_SRC_DIR"), env.subst("$PROJECT_INCLUDE_DIR")]
+    project_dir = env.subst("$PROJECT_DIR")
+    for lib_dir in env.get("LIBSOURCE_DIRS", []):
+        lib_dir = env.subst(lib_dir)
+        if os.path.abspath(lib_dir).startswith(os.path.abspath(project_dir) + os.sep):
+            paths.append(lib_dir)
+    # DSOs are resolved against the main program, their sources count as well
+    for line in str(env.GetProjectOption("custom_dsos", "")).strip().splitlines():
+        if ":" in line:
+            paths.extend(os.path.join(project_dir, src) for src in line.split(":", 1)[1].split())
+    return [p for p in paths if os.path.exists(p)]
 
+def select_libdragon_modules():
+    available = set(group_modules(libdragon_srcs + rsp_srcs))
+    requested = get_list_option(env, "custom_libdragon_modules") or ["all"]
+    if requested == ["all"]:
+        return available
+    index = load_module_index(
+        FRAMEWORK_DIR, libdragon_srcs + rsp_srcs,
+        platform.get_package_version("framework-libdragon"),
+        os.path.join(env.subst("$PROJECT_CORE_DIR"), ".cache", "nintendon64", "libdragon-modules.json"))
+    if requested == ["auto"]:
+        return detect_modules(index, scan_identifiers(project_source_paths()))
+    unknown = set(requested) - available
+    if unknown:
+        sys.stderr.write("Error: unknown libdragon modules in custom_libdragon_modules: %s (available: %s)\n" % (
+            ", ".join(sorted(unknown)), ", ".join(sorted(available))))
+        env.Exit(1)
+    return close_modules(index, requested)
 
-libs.append(
-    env.BuildLibrary(
-        os.path.join("$BUILD_DIR", "FrameworkLibdragonSys"),
-        os.path.join(FRAMEWORK_DIR, "src"),
-        "-<*> +<system.c>"
-    ))
+all_libdragon_modules = set(group_modules(libdragon_srcs + rsp_srcs))
+libdragon_modules = select_libdragon_modules()
+if libdragon_modules != all_libdragon_modules:
+    print("libdragon modules: %s (skipped: %s)" % (
+        ", ".join(sorted(libdragon_modules)), ", ".join(sorted(all_libdragon_modules - libdragon_modules))))
+    libdragon_srcs = [x for x in libdragon_srcs if module_of(x) in libdragon_modules]
+    rsp_srcs = [x for x in rsp_srcs if module_of(x) in libdragon_modules]
+
+def module_library_name(module):
+    return "FrameworkLibdragon_" + module
+
+def rsp_link_action(env, src_file, target_elf, target_map):
+    return env.VerboseAction(" ".join([
+        "$CC",
+        "-march=mips1",
+        "-mabi=32",
+        "-Wa,--fatal-warnings",
+        "-nostartfiles",
+        "-I",
+        '"%s"' % os.path.join(FRAMEWORK_DIR, "src"),
+        "-I",
+        '"%s"' % os.path.join(FRAMEWORK_DIR, "include"),
+        "-L",
+        '"%s"' % os.path.join(FRAMEWORK_DIR),
+        "-Wl,-Trsp.ld",
+        "-Wl,--gc-sections",
+        '-Wl,-Map="%s"' % target_map,
+        "-o",
+        '"%s"' % target_elf,
+        '"%s"' % str(src_file)
+    ]), "Relinking RSP ELF " + target_elf)
+
+def write_rsp_object(target_elf, src_filename, output):
+    """
+    Pure Python replacement for the objcopy -O binary / objcopy -I binary / ld -relocatable
+    steps: put .text, .data (and .meta) of the linked RSP ELF into one object file.
+    """
+    rsp_elf = ElfFile.read(target_elf)
+    blobs = [
+        (src_filename + "_text", rsp_elf.section_data(".text")),
+        (src_filename + "_data", rsp_elf.section_data(".data")),
+    ]
+    if is_preview_branch:
+        # same fixup as for the objcopy path: an empty .meta must still be one byte long
+        blobs.append((src_filename + "_meta", rsp_elf.section_data(".meta") or b"\x00"))
+    write_blob_object(output, blobs)
 
 def post_process_rsp_file(source, target, env):
-    global is_preview_branch
+    src_file = source[0] # the .S file
+    src_filename = os.path.splitext(os.path.basename(str(source[0])))[0]
+    target_file = str(target[0]) # the .o file
+    target_elf = os.path.splitext(target_file)[0] + ".elf"
+    target_map = os.path.splitext(target_file)[0] + ".map"
+    with span("RSP " + os.path.basename(str(src_file)), "rsp"):
+        if rsp_pipeline == "tools":
+            return post_process_rsp_file_tools(source, target, env)
+        if rsp_pipeline == "verify":
+            result = post_process_rsp_file_tools(source, target, env)
+            if result:
+                return result
+            write_rsp_object(target_elf, src_filename, target_file + ".native")
+            diffs = compare_blob_objects(target_file, target_file + ".native")
+            if diffs:
+                print("Error: native RSP object differs from the objcopy / ld output for %s:" % src_file)
+                for diff in diffs:
+                    print("  " + diff)
+                return 1
+            print("Verified native RSP object for %s" % src_file)
+            return None
+        result = env.Execute(rsp_link_action(env, src_file, target_elf, target_map))
+        if result:
+            return result
+        write_rsp_object(target_elf, src_filename, target_file)
+        return None
+
+def post_process_rsp_file_tools(source, target, env):
     src_file = source[0] # the .S file
     src_filename = os.path.splitext(os.path.basename(str(source[0])))[0]
     target_file = target[0] # the .o file
@@ -159,25 +349,7 @@ def post_process_rsp_file(source, target, env):
     target_metasection = os.path.splitext(str(target_file))[0] + ".meta"
     symprefix = str(os.path.splitext(str(target_file))[0]).replace(".", "_").replace("/", "_").replace("\\", "_")
     actions = [
-        env.VerboseAction(" ".join([
-            "$CC",
-            "-march=mips1",
-            "-mabi=32",
-            "-Wa,--fatal-warnings",
-            "-nostartfiles",
-            "-I",
-            '"%s"' % os.path.join(FRAMEWORK_DIR, "src"),
-            "-I",
-            '"%s"' % os.path.join(FRAMEWORK_DIR, "include"),
-            "-L",
-            '"%s"' % os.path.join(FRAMEWORK_DIR),
-            "-Wl,-Trsp.ld",
-            "-Wl,--gc-sections",
-            '-Wl,-Map="%s"' % target_map,
-            "-o",
-            '"%s"' % target_elf,
-            '"%s"' % str(src_file)
-        ]), "Relinking RSP ELF " + target_elf),
+        rsp_link_action(env, src_file, target_elf, target_map),
         # make a copy of the original stripped elf because the compress is in-place
         #Copy(target_elf, target_file),
         env.VerboseAction(" ".join([
@@ -297,39 +469,212 @@ def post_process_rsp_file(source, target, env):
             '"%s"' % str(target_file)
         ]), "Relinking object file " + str(target_file)),
     ])
-    env.Execute(actions)
+    return env.Execute(actions)
 
-# Add a new builder. After many tries with post actions, this actually works.
-env.Append(BUILDERS={'CustomRspBuilder': Builder(action=post_process_rsp_file, suffix=".o")})
+# tools: the original objcopy / ld -relocatable chain (default)
+# native: link with gcc, then extract and repackage the sections in Python
+# verify: both, and fail if the resulting objects don't carry the same blobs
+rsp_pipeline = str(env.GetProjectOption("custom_rsp_pipeline", "tools")).strip().lower()
 
-rsp_env = env.Clone()
-rsp_env.Replace(
-    AS="mips64-elf-gcc",
-    LINK="mips64-elf-gcc",
-    ASFLAGS=[
-        "-march=mips1",
-        "-mabi=32",
-        "-Wa,--fatal-warnings",
-    ]
+def rsp_emitter(target, source, env):
+    """ Declare the intermediate files and what the ucode depends on besides its includes. """
+    base = os.path.splitext(str(target[0]))[0]
+    target.extend([base + ".elf", base + ".map"])
+    if rsp_pipeline != "native":
+        for section in ("text", "data") + (("meta",) if is_preview_branch else ()):
+            target.extend(["%s.%s.bin" % (base, section), "%s.%s.o" % (base, section)])
+    if rsp_pipeline == "verify":
+        target.append(base + ".o.native")
+    env.Depends(target, os.path.join(FRAMEWORK_DIR, "rsp.ld"))
+    env.Depends(target, env.Value(rsp_pipeline))
+    return target, source
+
+# RSP sources pull in rsp_queue.inc etc. through both #include and .include
+rsp_scanner = SCons.Scanner.ClassicCPP(
+    "RspScanner",
+    [".S", ".s", ".inc", ".h"],
+    "RSP_CPPPATH",
+    r'^[ \t]*[#.][ \t]*include[ \t]*(<|")([^>"]+)[>"]'
+)
+
+# A real builder, so that the ucode is only relinked when the source, one of its
+# includes or rsp.ld changes, and runs in parallel with everything else.
+env.Append(
+    RSP_CPPPATH=[os.path.join(FRAMEWORK_DIR, "src"), os.path.join(FRAMEWORK_DIR, "include")],
+    BUILDERS={"RspUcode": Builder(
+        action=env.VerboseAction(post_process_rsp_file, "Building RSP ucode $TARGET"),
+        emitter=rsp_emitter,
+        source_scanner=rsp_scanner,
+        suffix=".o",
+        single_source=True
+    )}
 )
 
 def build_rsp_file(env, node):
-    ret = rsp_env.CustomRspBuilder(node)
-    return ret
+    return env.RspUcode(node)[0]
 
 # Somehow only works for files in the user's project directory
 env.AddBuildMiddleware(build_rsp_file, "**/rsp*.S")
 
-# get RSP sources into the build system. Sadly we must rebuild the ".o" entirely because
-# we need to link it as a fully fledged ELF file, then extract .data and .text sections out of it,
-# and then repackage it, with changed symbol names, into an elf / object file that will finally be linked.
-rsp_env.BuildSources(
-     os.path.join("$BUILD_DIR", "FrameworkLibdragonRSP"),
-     os.path.join(FRAMEWORK_DIR, "src"),
-     "-<*> " + " ".join(["+<%s>" % src for src in rsp_srcs])
-)
+#
+# Prebuilt framework cache: the archives and RSP objects only depend on the framework
+# sources, the toolchain version and the flags they are built with, so they are shared
+# between all projects (and clean builds) that use the same combination.
+#
+def rsp_object_path(src):
+    return os.path.join("$BUILD_DIR", "FrameworkLibdragonRSP", os.path.splitext(src)[0] + ".o")
+
+def libdragon_cache_key():
+    """ Only valid once the flags are final, see BuildLibdragon(). """
+    flags = env.subst(" ".join([
+        "$CCFLAGS", "$CFLAGS", "$CXXFLAGS", "$ASFLAGS", "$ASPPFLAGS", "$_CPPDEFFLAGS"
+    ]))
+    return hashlib.sha256(json.dumps([
+        3, # bump when the layout of the cached artifacts changes
+        platform.get_package_version("framework-libdragon"),
+        # symlinked (development) checkouts change without a new version. Their folder
+        # mtimes are known from the source scan, they change when files are added,
+        # removed or saved through a rename (as most editors do).
+        "" if os.path.isfile(os.path.join(FRAMEWORK_DIR, ".piopm")) else folders_signature(
+            os.path.join(FRAMEWORK_DIR, "src"), platform.get_package_version("framework-libdragon"),
+            libdragon_sources_cache),
+        platform.get_package_version("toolchain-gccmips64"),
+        env.GetBuildType(),
+        # the framework path only ends up in -ffile-prefix-map, keep the key portable
+        flags.replace(FRAMEWORK_DIR, "<libdragon>"),
+        chip,
+        is_preview_branch,
+        sorted(libdragon_srcs + rsp_srcs),
+        unity_build and unity_exclude,
+    ]).encode()).hexdigest()
+
+# name in the cache entry -> path in the build folder
+libdragon_artifacts = {
+    "libFrameworkLibdragonSys.a": os.path.join("$BUILD_DIR", "libFrameworkLibdragonSys.a"),
+}
+for module in sorted(group_modules(libdragon_srcs)):
+    name = "lib%s.a" % module_library_name(module)
+    libdragon_artifacts[name] = os.path.join("$BUILD_DIR", name)
 for src in rsp_srcs:
-    # actual build logic happens in the post processing. The regular "build" step is just enough to not crash.
-    env.AddPostAction("$BUILD_DIR/FrameworkLibdragonRSP/%s.o" % src.replace(".S", ""), post_process_rsp_file)
+    libdragon_artifacts["rsp__" + src.replace("/", "__").replace("\\", "__")[:-2] + ".o"] = rsp_object_path(src)
+
+def restore_prebuilt_libdragon(cache, key, stamp):
+    """ Put the cached artifacts into the build folder, returns False on a cache miss. """
+    artifacts = {name: env.subst(path) for name, path in libdragon_artifacts.items()}
+    if os.path.isfile(stamp) and all(os.path.isfile(p) for p in artifacts.values()):
+        with open(stamp, "r") as f:
+            if f.read().strip() == key:
+                return True
+    for path in artifacts.values():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    if not cache.get(key, artifacts):
+        return False
+    with open(stamp, "w") as f:
+        f.write(key)
+    return True
+
+def store_prebuilt_libdragon(target, source, env):
+    cache_key = source[-1].read()
+    cache.put(cache_key, {name: env.subst(path) for name, path in libdragon_artifacts.items()})
+    # once at the end of the build, not while other actions are running
+    atexit.register(cache.trim)
+    with open(str(target[0]), "w") as f:
+        f.write(cache_key)
+
+#
+# The framework is handed to SCons as a list of object nodes, per-file flags are attached
+# right here instead of matching build middleware patterns against every source.
+#
+def framework_object(src, variant="FrameworkLibdragon"):
+    """ Object node for one file of libdragon's src/ folder. """
+    src_path = os.path.join(FRAMEWORK_DIR, "src", src)
+    ccflags = env["CCFLAGS"]
+    if src == "audio/libopus.c":
+        ccflags = ccflags + no_warnings_flags
+    pch = pch_for(src_path)
+    if pch is not None:
+        ccflags = ["-include", pch[0]] + ccflags
+    overrides = {"CCFLAGS": ccflags} if ccflags is not env["CCFLAGS"] else {}
+    obj = env.Object(
+        os.path.join("$BUILD_DIR", variant, os.path.splitext(src)[0] + ".o"),
+        src_path,
+        **overrides
+    )
+    if pch is not None:
+        env.Depends(obj, pch[1])
+    return obj
+
+#
+# Unity build: the C files of every module (top-level folder of src/) are compiled as
+# one translation unit, so libdragon.h and friends are parsed once per module.
+# libopus.c keeps its own unit (and its warning flags), RSP ucode is not affected.
+# Files that don't like to share a unit can be kept apart with custom_libdragon_unity_exclude.
+#
+unity_build = get_bool_option(env, "custom_libdragon_unity")
+unity_exclude = ["audio/libopus.c"] + get_list_option(env, "custom_libdragon_unity_exclude")
+
+def unity_objects(srcs):
+    units, separate = group_unity_sources(srcs, unity_exclude)
+    objects = []
+    for module, files in sorted(units.items()):
+        unity_src = env.subst(os.path.join("$BUILD_DIR", "FrameworkLibdragonUnity", module + ".c"))
+        write_unity_source(unity_src, [os.path.join(FRAMEWORK_DIR, "src", f) for f in files])
+        objects.append(env.Object(os.path.splitext(unity_src)[0] + ".o", unity_src))
+    objects.extend(framework_object(src) for src in separate)
+    return objects
+
+def build_module_library(module, srcs):
+    return env.StaticLibrary(
+        os.path.join("$BUILD_DIR", module_library_name(module)),
+        unity_objects(srcs) if unity_build else [framework_object(src) for src in srcs]
+    )
+
+cache = get_build_cache(env, "libdragon", "custom_libdragon_cache", "custom_libdragon_cache_size", 1024 ** 3)
+cache_stamp = env.subst(os.path.join("$BUILD_DIR", "FrameworkLibdragon.cachekey"))
+
+def build_libdragon(env):
+    """
+    Restore libdragon from the prebuilt cache, or create the nodes that build it.
+    PlatformIO applies the debug target's flags and build_unflags only after the
+    framework scripts ran, so main.py calls this after BuildProgram(), when the flags
+    (and so the cache key and the flags of every object) are final. The archives and
+    RSP objects are already in LIBS and PIOBUILDFILES by their paths.
+    """
+    cache_key = libdragon_cache_key() if cache is not None else ""
+    if cache is not None and restore_prebuilt_libdragon(cache, cache_key, cache_stamp):
+        print("Using prebuilt libdragon from cache (%s)" % cache_key[:12])
+        return
+
+    for module, srcs in sorted(group_modules(libdragon_srcs).items()):
+        build_module_library(module, srcs)
+
+    env.StaticLibrary(
+        os.path.join("$BUILD_DIR", "FrameworkLibdragonSys"),
+        [framework_object("system.c", "FrameworkLibdragonSys")]
+    )
+
+    # We must link each ucode as a fully fledged ELF file, then extract .data and .text
+    # sections out of it and repackage them, with changed symbol names, into an object
+    # file that will finally be linked. All done by the RspUcode builder.
+    for src in rsp_srcs:
+        env.RspUcode(rsp_object_path(src), os.path.join(FRAMEWORK_DIR, "src", src))
+
+    if cache is not None:
+        # stores the freshly built artifacts in the cache, the program depends on it so that it always runs
+        cache_store = env.Command(
+            cache_stamp,
+            [env.File(path) for path in libdragon_artifacts.values()] + [env.Value(cache_key)],
+            env.VerboseAction(store_prebuilt_libdragon, "Storing prebuilt libdragon in cache")
+        )
+        env.Depends(os.path.join("$BUILD_DIR", "${PROGNAME}.elf"), cache_store)
+
+env.AddMethod(build_libdragon, "BuildLibdragon")
+
+# get the archives and RSP objects into the build system, BuildLibdragon() decides
+# whether they come from the cache or are built from source
+libs.extend(env.File(path) for path in libdragon_artifacts.values() if path.endswith(".a"))
+env.Append(PIOBUILDFILES=[env.File(rsp_object_path(src)) for src in rsp_srcs])
 
-env.Prepend(LIBS=libs)
\ No newline at end of file
+# BuildProgram() links the libraries in a group, so the module archives can
+# reference each other in both directions
+env.Prepend(LIBS=libs)
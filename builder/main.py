@@ -12,23 +12,36 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import io
 import sys
-from platform import system
-from os import makedirs, environ, listdir, makedirs, walk, sep
-from os.path import basename, isdir, isfile, join, exists, relpath, dirname, abspath
-from pathlib import Path
-import shutil
-import glob
+from contextlib import redirect_stdout
+from os import environ, listdir, remove, replace
+from os.path import basename, isdir, isfile, join, exists, getmtime
 
 from SCons.Script import (ARGUMENTS, COMMAND_LINE_TARGETS, AlwaysBuild,
-                          Builder, Default, DefaultEnvironment, Copy, Scanner)
-
-from platformio.public import list_serial_ports
+                          Builder, Default, DefaultEnvironment, Scanner)
 
 env = DefaultEnvironment()
 platform = env.PioPlatform()
 board = env.BoardConfig()
 
+# make the helper modules in builder/n64 importable
+sys.path.insert(0, join(platform.get_dir(), "builder"))
+from n64.assets import (asset_cache_clean, asset_cache_stats, convert_assets,
+                        convert_assets_emitter, get_asset_jobs_count)
+from n64.budget import BudgetError, check_budgets, get_rdram_size
+from n64.cc_cache import compiler_cache_clean, compiler_cache_stats, enable_compiler_cache
+from n64.compress import (compress, compress_dso_level, compress_elf_level, get_compression_budget,
+                          get_compression_level)
+from n64.depfiles import DEPFILE_SUFFIX, scan_depfile
+from n64.dfs import build_dfs
+from n64.options import get_list_option
+from n64.rom import build_rom, rom_title
+from n64.size_analysis import size_analysis_action
+from n64.sizereport import sizereport_action
+from n64.trace import enable_build_trace
+
 env.Replace(
     AR="mips64-elf-gcc-ar",
     AS="mips64-elf-as",
@@ -58,14 +71,63 @@ env.Replace(
 
     ARFLAGS=["rc"],
 
-    SIZEPROGREGEXP=r"^(?:\.text|\.data|\.rodata|\.text.align|\.ARM.exidx)\s+(\d+).*",
-    SIZEDATAREGEXP=r"^(?:\.data|\.bss|\.sbss|\.sdata|\.lit8|\.lit4|\.noinit)\s+(\d+).*",
+    # what the ELF stores: code and initialized data of the MIPS sections
+    SIZEPROGREGEXP=r"^(?:\.text|\.text\.align|\.init|\.fini|\.ctors|\.dtors|\.eh_frame|\.gcc_except_table|\.rodata|\.data|\.sdata|\.lit8|\.lit4)\s+(\d+).*",
+    # what is resident in RDRAM: the code runs from RDRAM, so everything that is loaded
+    SIZEDATAREGEXP=r"^(?:\.text|\.text\.align|\.init|\.fini|\.ctors|\.dtors|\.eh_frame|\.gcc_except_table|\.rodata|\.data|\.sdata|\.lit8|\.lit4|\.bss|\.sbss|\.noinit)\s+(\d+).*",
     SIZECHECKCMD="$SIZETOOL -A -d $SOURCES",
     SIZEPRINTCMD='$SIZETOOL -B -d $SOURCES',
 
     PROGSUFFIX=".elf"
 )
 
+# Decide by timestamp first and only hash files whose timestamp changed, so an
+# up-to-date project (including the whole libdragon tree) is checked quickly.
+env.Decider("MD5-timestamp")
+
+# fail early on an invalid custom_elf_compression, not when the ELF is compressed
+try:
+    get_compression_level(env)
+except ValueError as e:
+    sys.stderr.write("Error: %s\n" % e)
+    env.Exit(1)
+
+# fail early on an invalid custom_asset_jobs, not in the middle of converting assets
+get_asset_jobs_count(env)
+
+# RDRAM size (custom_rdram_size = 8MB with the Expansion Pak), also shown by checkprogsize
+try:
+    rdram_size = get_rdram_size(env)
+except BudgetError as e:
+    sys.stderr.write("Error: %s\n" % e)
+    env.Exit(1)
+if env.GetProjectOption("custom_rdram_size", ""):
+    board.update("upload.maximum_ram_size", rdram_size)
+
+# Optional timeline of the whole build in Chrome trace format
+if env.GetProjectOption("custom_build_trace", ""):
+    enable_build_trace(env, env.GetProjectOption("custom_build_trace"))
+
+# Compile through the cross-project compiler result cache (opt-in, custom_compiler_cache = yes)
+enable_compiler_cache(env)
+
+# Header dependencies come from the depfiles gcc writes while compiling, instead of
+# SCons' C scanner parsing every source and header (custom_header_deps = scanner).
+if str(env.GetProjectOption("custom_header_deps", "depfile")).strip().lower() != "scanner":
+    env.Replace(
+        N64_DEPFLAGS=["-MMD", "-MF", "${TARGET}" + DEPFILE_SUFFIX],
+        N64_DEPFILE_SCANNER=Scanner(function=scan_depfile, name="DepfileScanner"),
+    )
+    for com in ("CCCOM", "CXXCOM", "ASPPCOM"):
+        env[com] = env[com] + " $N64_DEPFLAGS"
+    no_scanner = Scanner(function=lambda node, env, path: [], name="NoScanner")
+    for name in ("StaticObject", "SharedObject"):
+        # these are CompositeBuilder proxies, which don't pass attribute writes on to
+        # the builder the object nodes use
+        builder = getattr(env["BUILDERS"][name], "builder", env["BUILDERS"][name])
+        builder.source_scanner = no_scanner
+        builder.target_scanner = env["N64_DEPFILE_SCANNER"]
+
 # N64Tool needs this to locate mips64-elf-readelf and similiar tools
 environ["N64_INST"] = platform.get_package_dir("toolchain-gccmips64")
 
@@ -73,98 +135,41 @@ environ["N64_INST"] = platform.get_package_dir("toolchain-gccmips64")
 if env.get("PROGNAME", "program") == "program":
     env.Replace(PROGNAME="firmware")
 
-def process_directory(target, source, env):
-    env.Depends(target, source)
-    tgt_dir = abspath(str(target[0]))
-
-    # Ensure target directory exists
-    if exists(tgt_dir):
-        shutil.rmtree(tgt_dir)
-    makedirs(tgt_dir, exist_ok=True)
-
-    # Retrieve custom conversion rules from platformio.ini
-    conv_rules: str = env.GetProjectOption("custom_conversions", "")
-    custom_conversions = {}
-    if conv_rules:
-        for line in conv_rules.strip().split("\n"):
-            parts = [part.strip() for part in line.split(",", maxsplit=2)]
-            if len(parts) == 3:
-                command_template = parts[2].strip()
-                if "$SOURCE" not in command_template:
-                    command_template += " $SOURCE"
-                custom_conversions[parts[0].lower()] = (parts[1].strip(), command_template)
-
-    def process_file(src_file, tgt_dir):
-        """ Process a single file based on conversion rules or copy if no rule applies. """
-        file_name = basename(src_file)
-        file_lower = file_name.lower()
-        output_dir = tgt_dir
-        makedirs(output_dir, exist_ok=True)
-
-        if file_lower in custom_conversions:
-            target_ext, command_template = custom_conversions[file_lower]
-            tgt_file = join(output_dir, file_name[:file_name.rfind(".")] + target_ext)
-            src_parent_dir = abspath(dirname(src_file))
-            command = command_template.replace("$TARGETDIR", output_dir).replace("$TARGET", tgt_file).replace("$SOURCE", file_name)
-            if "${N64_MKFONT}" in command:
-                # the mkfont binary is special: it expects mksprite to be available at
-                # $N64_INST/bin/mksprite
-                # instead of patching the mkfont source code (which we can!), we just clone the env
-                # and set the N64_INST variable to the right folder.
-                # note that this only works because it doesn't access any compiler bins like mips64-elf-gcc
-                mkfont_env = env.Clone()
-                mkfont_env["ENV"]["N64_INST"] = platform.get_package_dir("tool-n64")
-                mkfont_env.Execute(env.VerboseAction(
-                    f"cd {src_parent_dir} && {command}",
-                    f"(Font) Converting {src_file} to {tgt_file}"
-                ))
-                mkfont_env["ENV"]["N64_INST"] = platform.get_package_dir("toolchain-gccmips64")
-            else:
-                env.Execute(env.VerboseAction(
-                    f"cd {src_parent_dir} && {command}",
-                    f"Converting {src_file} to {tgt_file}"
-                ))
-        elif file_lower.endswith(".xm"):
-            tgt_file = join(output_dir, file_name[:-3] + ".xm64")
-            env.Execute(env.VerboseAction(f"${{N64_AUDIOCONV}} -o {tgt_file} {src_file}",
-                                          f"Converting {src_file} to {tgt_file}"))
-        elif file_lower.endswith(".ym"):
-            tgt_file = join(output_dir, file_name[:-3] + ".ym64")
-            env.Execute(env.VerboseAction(f"${{N64_AUDIOCONV}} -o {tgt_file} {src_file}",
-                                          f"Converting {src_file} to {tgt_file}"))
-        elif file_lower.endswith(".wav"):
-            tgt_file = join(output_dir, file_name[:-4] + ".wav64")
-            env.Execute(env.VerboseAction(f"${{N64_AUDIOCONV}} --wav-compress 3 -o {tgt_file} {src_file}",
-                                          f"Converting {src_file} to {tgt_file}"))
-        elif file_lower.endswith(".png"):
-            tgt_file = join(output_dir, file_name[:-4] + ".sprite")
-            env.Execute(env.VerboseAction(
-                f"cd {dirname(src_file)} && ${{N64_MKSPRITE}} -o {output_dir} {file_name}",
-                f"Converting {src_file} to {tgt_file}"
-            ))
-        else:
-            tgt_file = join(output_dir, file_name)
-            shutil.copy2(src_file, tgt_file)
-            print(f"Copied: {src_file} -> {tgt_file}")
-        return tgt_file
-
-    # Process all source elements
-    for s in source:
-        s_path = str(s)
-        if isfile(s_path):
-            tgt = process_file(s_path, tgt_dir)
-        elif isdir(s_path):
-            for root, _, files in walk(s_path):
-                for file in files:
-                    tgt = process_file(join(root, file), tgt_dir)
-
-    return None  # Must return None to indicate success in SCons
-
 def build_custom_dsos(env):
+    """
+    Build every DSO of custom_dsos. Returns a list of (.dso, .dso.sym) target pairs.
+    Each DSO is linked, converted and symbolized by its own builders, so SCons can
+    run the steps of different DSOs in parallel.
+    """
     custom_dsos = str(env.GetProjectOption("custom_dsos", "")).strip()
     if not custom_dsos:
         return []
 
+    # One environment with the DSO-specific flags for all DSOs
+    dso_env = env.Clone()
+    dso_env.Append(
+        CCFLAGS=["-mno-gpopt", "-DN64_DSO"],
+        CPPPATH=join("$PROJECT_DIR", "include"),
+    )
+
+    platform = env.PioPlatform()
+    FRAMEWORK_DIR = platform.get_package_dir("framework-libdragon") or ""
+    dso_env.Replace(
+        LINK="mips64-elf-ld",
+        LINKFLAGS=[
+            "--emit-relocs",
+            "--unresolved-symbols=ignore-all",
+            "--nmagic",
+            "-L",
+            '"%s"' % FRAMEWORK_DIR,
+            "-T", "dso.ld"
+        ],
+        LIBS=[],
+        _LIBFLAGS="",
+        # DSOs are linked by plain ld, which can't do link time optimization
+        N64_LTOFLAGS=[],
+    )
+
     dso_targets = []
     for line in custom_dsos.splitlines():
         output_file, sources = line.split(":", maxsplit=1)
@@ -174,29 +179,6 @@ def build_custom_dsos(env):
         # Define the build directory for object files
         obj_dir = join("$BUILD_DIR", "dsos", output_file.replace(".dso", ""))
 
-        # Clone environment and configure DSO-specific flags
-        dso_env = env.Clone()
-        dso_env.Append(
-            CCFLAGS=["-mno-gpopt", "-DN64_DSO"],
-            CPPPATH=join("$PROJECT_DIR", "include"),
-        )
-
-        platform = env.PioPlatform()
-        FRAMEWORK_DIR = platform.get_package_dir("framework-libdragon") or ""
-        dso_env.Replace(
-            LINK="mips64-elf-ld",
-            LINKFLAGS=[
-                "--emit-relocs",
-                "--unresolved-symbols=ignore-all",
-                "--nmagic",
-                "-L",
-                '"%s"' % FRAMEWORK_DIR,
-                "-T", "dso.ld"
-            ],
-            LIBS=[],
-            _LIBFLAGS="",
-        )
-
         # Explicitly create object files in $BUILD_DIR
         object_files = []
         for src in sources:
@@ -210,46 +192,86 @@ def build_custom_dsos(env):
             target=join("$BUILD_DIR", output_file.replace(".dso", ".elf")),
             source=object_files,  # Use manually created object files
         )
+        dso_env.AddPostAction(dso_elf_target, env.VerboseAction(
+            "${SIZETOOL} -G $TARGET", "Checking size of $TARGET"))
 
-        # Convert ELF to DSO
-        dso_target = env.DsoBuilder(
-            target=[join("$BUILD_DIR", output_file), join("$BUILD_DIR", output_file + ".sym")],
-            source=dso_elf_target,
-        )
-        dso_targets.append(dso_target)
+        # Convert ELF to DSO, and generate its .sym file
+        dso_target = env.ElfToDso(join("$BUILD_DIR", output_file), dso_elf_target)
+        env.Depends(dso_target, compression_settings)
+        dso_sym_target = env.ElfToSym(join("$BUILD_DIR", output_file + ".sym"), dso_elf_target)
+        dso_targets.append((dso_target[0], dso_sym_target[0]))
 
     return dso_targets
 
-def dso_builder_action(target, source, env):
-    dso_elf = str(source[0])  # The program ELF file
-    dso_file = str(target[0])  # The output DSO file
-    dso_sym = str(target[1]) # The corresponding sym file
-    elf_dir = dirname(dso_elf)
-    # Define the absolute path to the filesystem folder
-    out_dir = join(env.subst("$BUILD_DIR"))
-
-    # Ensure the filesystem folder exists
-    if not exists(out_dir):
-        makedirs(out_dir)
-
-    actions = [
-        env.VerboseAction(
-            f"${{SIZETOOL}} -G {dso_elf}",
-            f"Checking size of {dso_elf}"),
-        # Generate the DSO file
-        env.VerboseAction(
-            f"cd {elf_dir} && ${{N64_DSO}} -o {out_dir} -c 1 {basename(dso_elf)}",
-            f"Creating DSO {dso_file} from ELF {dso_elf}"),
-        # Generate the .sym file
-        env.VerboseAction(" ".join([
-            "${N64SYM}",
-            dso_elf,
-            dso_sym
-        ]), f"Generating sym file {dso_sym} from ELF {dso_elf}")
-    ]
+def build_dso_externs(target, source, env):
+    """
+    Generate the linker script that keeps the symbols the DSOs import from the main
+    program. It is only written if its contents change, so changes inside a DSO
+    that don't change its imports don't relink the main program.
+    """
+    externs = target[0].get_abspath()
+    tmp = externs + ".tmp"
+    result = env.Execute(env.VerboseAction(
+        '"${N64_DSOEXTERN}" -o "%s" %s' % (tmp, " ".join('"%s"' % s.get_abspath() for s in source)),
+        "Building DSO externals %s" % externs))
+    if result:
+        return result
+    with open(tmp, "rb") as f:
+        new_hash = hashlib.sha256(f.read()).hexdigest()
+    old_hash = None
+    if isfile(externs):
+        with open(externs, "rb") as f:
+            old_hash = hashlib.sha256(f.read()).hexdigest()
+    if new_hash == old_hash:
+        remove(tmp)
+    else:
+        replace(tmp, externs)
+    return None
 
-    # Execute all actions
-    return env.Execute(actions)
+#
+# Program size check
+#
+# PlatformIO's "checkprogsize" target runs the size tool on every build. Instead,
+# the check runs once per linked ELF and keeps its report in <elf>.size, which
+# "checkprogsize" only prints as long as the ELF is unchanged.
+# The same action checks the RDRAM budget of the program and the DSOs (n64/budget.py).
+#
+
+check_upload_size = env.CheckUploadSize
+
+def size_check_action(target, source, env):
+    # source[0] is the program, the other sources are the ELFs of the DSOs
+    report = io.StringIO()
+    try:
+        with redirect_stdout(report):
+            check_upload_size(target, source, env)
+            breakdown, errors = check_budgets(
+                env, source[0].get_abspath(), [s.get_abspath() for s in source[1:]])
+            if errors or int(ARGUMENTS.get("PIOVERBOSE", 0)):
+                print("\n".join(breakdown))
+            else:
+                print(breakdown[-1])
+    except BudgetError as e:
+        errors = [str(e)]
+    finally:
+        sys.stdout.write(report.getvalue())
+    if errors:
+        for error in errors:
+            sys.stderr.write("Error: %s\n" % error)
+        return 1
+    with open(str(target[0]), "w") as f:
+        f.write(report.getvalue())
+
+def print_size_report(_, target, source, env):
+    elf = str(source[0])
+    report = elf + ".size"
+    if not isfile(report) or getmtime(report) < getmtime(elf):
+        return check_upload_size(target, source, env)
+    with open(report, "r") as f:
+        sys.stdout.write(f.read())
+
+# must be replaced before BuildProgram() creates the "checkprogsize" target
+env.AddMethod(print_size_report, "CheckUploadSize")
 
 env.Append(
     BUILDERS=dict(
@@ -263,6 +285,10 @@ env.Append(
             ]), "Building $TARGET"),
             suffix=".bin"
         ),
+        SizeCheck=Builder(
+            action=env.VerboseAction(size_check_action, "Checking size $SOURCE"),
+            suffix=".elf.size"
+        ),
         ElfToSym=Builder(
             action=env.VerboseAction(" ".join([
                 "$N64SYM",
@@ -290,104 +316,43 @@ env.Append(
             suffix=".elf.stripped"
         ),
         StrippedElfToCompressedElf=Builder(
-            action=[
-                # make a copy of the original stripped elf because the compress is in-place
-                Copy('${TARGET}', '${SOURCE}'),
-                env.VerboseAction(" ".join([
-                "$N64ELFCOMPRESS",
-                "-c",
-                "1", # compression level
-                "$TARGET"
-                ]), "Building $TARGET"),
-            ],
+            # compression level from custom_elf_compression, see n64/compress.py
+            action=env.VerboseAction(
+                lambda target, source, env: compress(
+                    env, compress_elf_level, source[0].get_abspath(), target[0].get_abspath(),
+                    get_compression_budget(env)),
+                "Building $TARGET"),
             suffix=".elf.stripped.compressed"
         ),
         ElfToZ64=Builder(
-            action=env.VerboseAction(" ".join([
-                "$N64TOOL",
-                "--title",
-                '"%s"' % "Controller Test",
-                "--toc",
-                "--output",
-                "$TARGET",
-                "--align",
-                "256",
-                "${SOURCES[0]}", # stripped + compressed elf file
-                "--align",
-                "8",
-                "${SOURCES[1]}", # symbol file
-                "--align",
-                "8"
-            ]), "Building $TARGET"),
-            suffix=".z64"
-        ),
-        ElfToZ64WithDFS=Builder(
-            action=env.VerboseAction(" ".join([
-                "$N64TOOL",
-                "--title",
-                '"%s"' % "Controller Test",
-                "--toc",
-                "--output",
-                "$TARGET",
-                "--align",
-                "256",
-                "${SOURCES[0]}", # stripped + compressed elf file
-                "--align",
-                "8",
-                "${SOURCES[1]}", # symbol file
-                "--align",
-                "16",
-                "${SOURCES[2]}" # dfs file (filesystem)
-            ]), "Building $TARGET"),
-            suffix=".z64"
-        ),
-        ElfToZ64WithDFSAndMSYS=Builder(
-            action=env.VerboseAction(" ".join([
-                "$N64TOOL",
-                "--title",
-                '"%s"' % "Controller Test",
-                "--toc",
-                "--output",
-                "$TARGET",
-                "--align",
-                "256",
-                "${SOURCES[0]}", # stripped + compressed elf file
-                "--align",
-                "8",
-                "${SOURCES[1]}", # symbol file
-                "--align",
-                "8",
-                "${SOURCES[2]}", # msym file
-                "--align",
-                "16",
-                "${SOURCES[3]}" # dfs file (filesystem)
-            ]), "Building $TARGET"),
+            # sources are the segments of the ROM, their alignments are in N64_ROM_ALIGN.
+            # Writes the ROM with n64tool, or patches the changed segments in place.
+            action=build_rom,
             suffix=".z64"
         ),
         ConvertAssets=Builder(
-            action=process_directory,
+            action=convert_assets,
+            emitter=convert_assets_emitter, # declares every converted file as a target
             source_factory=env.Entry, # Source should be a directory or file
             target_factory=env.Dir,  # Target should be a directory
         ),
         DataToDfs=Builder(
-            action=env.VerboseAction(" ".join([
-                '"$MKDFSTOOL"',
-                "$TARGET",
-                "$SOURCE"
-            ]), "Building file system image from '$SOURCE' directory to $TARGET"),
-            source_factory=env.Dir,
+            # sources are the files in the filesystem folder. Runs mkdfs on the folder,
+            # or patches the previous image in place if only some files changed.
+            action=build_dfs,
+            source_factory=env.File,
             suffix=".dfs"
         ),
-        DsoBuilder=Builder(
-            action=dso_builder_action,
+        ElfToDso=Builder(
+            # level from custom_elf_compression, see n64/compress.py
+            action=env.VerboseAction(
+                lambda target, source, env: compress(
+                    env, compress_dso_level, source[0].get_abspath(), target[0].get_abspath()),
+                "Creating DSO $TARGET from ELF $SOURCE"),
+            suffix=".dso"
         ),
         DsoExternsBuilder=Builder(
-            action=env.VerboseAction(" ".join([
-                "${N64_DSOEXTERN}",
-                "-o",
-                "$TARGET",
-                "$SOURCES"
-            ]), "Building DSO externals $TARGET"),
+            action=build_dso_externs,
             suffix=".externs"
         ),
     )
@@ -400,27 +365,58 @@ if not env.get("PIOFRAMEWORK"):
 # Target: Build executable and linkable firmware
 #
 
+# changing the compression options rebuilds the compressed ELF and the DSOs
+compression_settings = env.Value(repr([env.GetProjectOption(name, "") for name in (
+    "custom_elf_compression", "custom_elf_compression_budget", "custom_elf_compression_pi_speed")]))
+
 frameworks = env.get("PIOFRAMEWORK", [])
 
 target_elf = None
+dso_elfs = []
 if "nobuild" in COMMAND_LINE_TARGETS:
     target_elf = join("$BUILD_DIR", "${PROGNAME}.elf")
     target_z64 = join("$BUILD_DIR", "${PROGNAME}.z64")
     target_dfs = join("$BUILD_DIR", "${N64_FS_IMAGE_NAME}.dfs")
 else:
     target_elf = env.BuildProgram()
+    # libdragon's nodes depend on the final flags, which PlatformIO only has now
+    if any(f.startswith("libdragon") for f in frameworks):
+        env.BuildLibdragon()
+    # the objects of the program must be scanned through their depfiles, or every
+    # header is parsed again by SCons' C scanner on each build
+    if env.get("N64_DEPFILE_SCANNER"):
+        objects = [s for s in target_elf[0].sources if s.has_builder() and s.get_suffix() == env.subst("$OBJSUFFIX")]
+        if objects and objects[0].get_target_scanner() is not env["N64_DEPFILE_SCANNER"]:
+            sys.stderr.write("Error: the object builders don't use the depfile scanner, "
+                             "set custom_header_deps = scanner\n")
+            env.Exit(1)
     target_sym = env.ElfToSym(join("$BUILD_DIR", "${PROGNAME}"), target_elf)
     target_stripped_elf = env.ElfToStrippedElf(join("$BUILD_DIR", "${PROGNAME}"), target_elf)
     target_stripped_compressed_elf = env.StrippedElfToCompressedElf(join("$BUILD_DIR", "${PROGNAME}"), target_stripped_elf)
+    env.Depends(target_stripped_compressed_elf, compression_settings)
 
     # Filesystem handling
     data_dir = join(env.subst("$PROJECT_DIR"), env.subst("$PROJECT_DATA_DIR"))
     filesystem_dir = join("$BUILD_DIR", "filesystem")
     custom_dsos = build_custom_dsos(env)
+    dso_elfs = [dso.sources[0] for dso, _ in custom_dsos]
+
+    # size and RDRAM budget of the program including the DSOs, once per link
+    target_size_check = env.SizeCheck(join("$BUILD_DIR", "${PROGNAME}"), [target_elf] + dso_elfs)
+    env.Depends(target_size_check, env.Value(repr([env.GetProjectOption(name, "") for name in (
+        "custom_rdram_size", "custom_rdram_reserve", "custom_section_budgets", "custom_dso_budgets",
+        "custom_dso_resident_sets")])))
+    env.Depends(env.Alias("checkprogsize"), target_size_check)
 
     data_dir_exists = exists(data_dir) and isdir(data_dir) and len(listdir(data_dir)) != 0
     has_custom_dsos = bool(custom_dsos)
 
+    # ROM layout: every segment is (file, alignment in the ROM)
+    rom_layout = [
+        (target_stripped_compressed_elf[0], 256),  # IPL3 looks for the ELF on 256 byte boundaries
+        (target_sym[0], 8),
+    ]
+
     if data_dir_exists or has_custom_dsos:
         asset_sources = []
 
@@ -432,46 +428,59 @@ else:
             asset_sources.extend([x for pair in custom_dsos for x in pair])
 
         target_converted_assets = env.ConvertAssets(filesystem_dir, asset_sources)
+        # SCons would delete all converted files before running the action, the
+        # manifest decides which ones are converted again
+        env.Precious(target_converted_assets)
 
+        # The emitter of ConvertAssets declares every output file, so the DFS image
+        # is only rebuilt if one of the converted files actually changed its content.
         target_dfs = env.DataToDfs(join("$BUILD_DIR", "${N64_FS_IMAGE_NAME}"), target_converted_assets)
-
-        # Track changes and rebuild filesystem if any asset file changes, as-needed. 
-        # TODO: This doesn't work at all. It's worked-around by AlwaysBuild() below.
-        # The target_converted_assets / env.ConvertAssets() build doesn't properly know about
-        # what output files it will produce, it might need an emitter function to properly track
-        # its targets and dependencies.
-        AlwaysBuild(target_converted_assets)
-        AlwaysBuild(target_dfs)
+        # SCons must not delete the old image before building, it may just get patched
+        env.Precious(target_dfs)
 
         if has_custom_dsos:
             # the .externs file is only built from the .dso files, not .dso.sym files
             target_dso_externs = env.DsoExternsBuilder(
                 join("${BUILD_DIR}", "${PROGNAME}.externs"), 
-                [x for pair in custom_dsos for x in pair if str(x).endswith(".dso")]
+                [dso for dso, _ in custom_dsos]
             )
+            # Precious: SCons must not delete the file before the action decides to keep it
+            env.Precious(target_dso_externs)
             env.Append(LINKFLAGS=["-Wl,-T", str(target_dso_externs[0])])
-            # .externs file must exist before elf is linked!! (because it's a linker script)
-            env.Requires(target_elf, target_dso_externs)
+            # .externs file must exist before elf is linked (because it's a linker script),
+            # and the elf is relinked when the imported symbols change
+            env.Depends(target_elf, target_dso_externs)
             target_msym = env.ElfToMSym(join("$BUILD_DIR", "${PROGNAME}"), target_elf)
-            target_z64 = env.ElfToZ64WithDFSAndMSYS(
-                join("$BUILD_DIR", "${PROGNAME}"),
-                [target_stripped_compressed_elf, target_sym, target_msym, target_dfs]
-            )
-        else:
-            target_z64 = env.ElfToZ64WithDFS(
-                join("$BUILD_DIR", "${PROGNAME}"),
-                [target_stripped_compressed_elf, target_sym, target_dfs]
-            )
-    else:
-        target_z64 = env.ElfToZ64(
-            join("$BUILD_DIR", "${PROGNAME}"),
-            [target_stripped_compressed_elf, target_sym]
-        )
+            rom_layout.append((target_msym[0], 8))
+        rom_layout.append((target_dfs[0], 16))
+
+    # additional files for the ROM's TOC, one "path" or "path:alignment" per line
+    for extra in get_list_option(env, "custom_rom_extra"):
+        path, _, align = extra.rpartition(":")
+        if not path or not align.isdigit():
+            path, align = extra, "8"
+        if int(align) < 1 or int(align) & (int(align) - 1):
+            sys.stderr.write("Error: custom_rom_extra: alignment of %s must be a power of two\n" % path)
+            env.Exit(1)
+        rom_layout.append((env.File(join("$PROJECT_DIR", path)), int(align)))
+
+    title = rom_title(env.GetProjectOption("custom_rom_title", basename(env.subst("$PROJECT_DIR"))))
+    target_z64 = env.ElfToZ64(
+        join("$BUILD_DIR", "${PROGNAME}"),
+        [segment for segment, _ in rom_layout],
+        N64_ROM_ALIGN=[align for _, align in rom_layout],
+        N64_ROM_END_ALIGN=8,
+        N64_ROM_TITLE=title,
+    )
+    # the layout decides how the ROM is written, not only the segment contents
+    env.Depends(target_z64, env.Value(repr([title] + [(str(s), align) for s, align in rom_layout])))
+    # SCons must not delete the old ROM before building, it may just get patched
+    env.Precious(target_z64)
 
-    env.Depends(target_z64, "checkprogsize")
-    AlwaysBuild(target_z64)
+    # a program that doesn't fit must not end up in a ROM
+    env.Depends(target_z64, target_size_check)
 
-AlwaysBuild(env.Alias("nobuild", target_z64))
+env.Alias("nobuild", target_z64)
 target_buildprog = env.Alias("buildprog", target_z64, target_z64)
 
 #
@@ -481,7 +490,9 @@ target_buildprog = env.Alias("buildprog", target_z64, target_z64)
 target_size = env.Alias(
     "size", target_elf,
     env.VerboseAction("$SIZEPRINTCMD", "Calculating size $SOURCE"))
-AlwaysBuild(target_size)
+# only when asked for, PlatformIO replaces it with "checkprogsize" in the default targets
+if "size" in COMMAND_LINE_TARGETS:
+    AlwaysBuild(target_size)
 
 #
 # Target: Upload by default .z64 file
@@ -519,6 +530,71 @@ else:
 AlwaysBuild(env.Alias("upload", upload_source, upload_actions))
 
 # additional project tasks
+env.AddPlatformTarget(
+    name="asset_cache_stats",
+    dependencies=None,
+    actions=[env.VerboseAction(asset_cache_stats, "Reading asset cache statistics")],
+    title="Asset Cache Statistics"
+)
+env.AddPlatformTarget(
+    name="asset_cache_clean",
+    dependencies=None,
+    actions=[env.VerboseAction(asset_cache_clean, "Cleaning asset cache")],
+    title="Clean Asset Cache"
+)
+#
+# Target: Build the project with every optimization profile and compare the results
+#
+
+env.AddPlatformTarget(
+    name="opt_profile_compare",
+    dependencies=None,
+    actions=[env.VerboseAction(" ".join([
+        '"$PYTHONEXE"',
+        '"%s"' % join(platform.get_dir(), "misc", "scripts", "bench_build.py"),
+        '"$PROJECT_DIR"',
+        '-e "$PIOENV"',
+        " ".join("-v %s:custom_opt_profile=%s" % (p, p) for p in ("speed", "size", "lto", "lto-size")),
+        '--json "%s"' % join("$BUILD_DIR", "opt_profiles.json"),
+    ]), "Comparing optimization profiles")],
+    title="Compare Optimization Profiles"
+)
+
+env.AddPlatformTarget(
+    name="compiler_cache_stats",
+    dependencies=None,
+    actions=[env.VerboseAction(compiler_cache_stats, "Reading compiler cache statistics")],
+    title="Compiler Cache Statistics"
+)
+env.AddPlatformTarget(
+    name="compiler_cache_clean",
+    dependencies=None,
+    actions=[env.VerboseAction(compiler_cache_clean, "Cleaning compiler cache")],
+    title="Clean Compiler Cache"
+)
+
+#
+# Target: Per-symbol sizes and code / data duplicated between the main program and the DSOs
+#
+
+env.AddPlatformTarget(
+    name="size_analysis",
+    dependencies=[target_elf] + dso_elfs,
+    actions=[env.VerboseAction(size_analysis_action, "Analyzing sizes and duplicates")],
+    title="Size and Duplication Analysis"
+)
+
+#
+# Target: Size per archive / object / symbol from the linker map, compared to the last report
+#
+
+env.AddPlatformTarget(
+    name="sizereport",
+    dependencies=target_elf,
+    actions=[env.VerboseAction(sizereport_action, "Reading linker map")],
+    title="Size Report"
+)
+
 if upload_protocol == "sc64":
     sc64_tool = join(platform.get_package_dir("tool-summercart64") or "", "sc64deployer")
     env.AddPlatformTarget(
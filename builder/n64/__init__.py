@@ -0,0 +1,18 @@
+# Copyright 2024-present Maximilian Gerhardt <maximilian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Helper modules shared by the N64 builder scripts (main.py, frameworks/*.py).
+# They are plain Python and must not rely on being run as a SConscript.
+#
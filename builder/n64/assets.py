@@ -0,0 +1,691 @@
+# Copyright 2024-present Maximilian Gerhardt <maximilian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Asset conversion pipeline: turns the files in the project's "assets" folder
+# (plus built DSOs) into the flat "filesystem" folder that is packed into the DFS.
+#
+# Every asset is described by an AssetJob. The same planning function is used by
+# the SCons emitter (to declare every output file) and by the build action, and a
+# per-asset manifest makes sure only assets whose input, command line or tool
+# binary changed are converted again.
+#
+
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from os import listdir, makedirs, remove, replace, stat, walk
+from os.path import basename, dirname, isdir, isfile, join
+
+from SCons.Script import ARGUMENTS
+
+from .cache import format_size, get_build_cache
+from .trace import span
+
+MANIFEST_VERSION = 1
+CACHE_VERSION = 1
+
+# placeholders used in recipes, so that a recipe does not depend on where the
+# project or the build folder is located.
+PH_SOURCE = "@SOURCE@"
+PH_TARGET = "@TARGET@"
+PH_TARGETDIR = "@TARGETDIR@"
+
+
+@dataclass
+class AssetJob:
+    source: str  # absolute path of the input file
+    target: str  # absolute path of the output file in the filesystem folder
+    # conversion command with the placeholders above, already substituted by SCons.
+    # empty for files that are copied as-is.
+    recipe: str = ""
+    description: str = ""
+    # additional environment variables for the conversion tool (mkfont needs N64_INST)
+    env_overrides: dict = field(default_factory=dict)
+
+    @property
+    def cwd(self):
+        return dirname(self.source)
+
+    @property
+    def tool(self):
+        return self.recipe.split()[0] if self.recipe else ""
+
+    def command(self):
+        return self.recipe.replace(PH_TARGETDIR, dirname(self.target)) \
+            .replace(PH_TARGET, self.target) \
+            .replace(PH_SOURCE, basename(self.source))
+
+
+def parse_conversion_rules(env):
+    """ Parse the custom_conversions option into {file name: (target ext, command template)}. """
+    conv_rules: str = env.GetProjectOption("custom_conversions", "")
+    custom_conversions = {}
+    if conv_rules:
+        for line in conv_rules.strip().split("\n"):
+            parts = [part.strip() for part in line.split(",", maxsplit=2)]
+            if len(parts) == 3:
+                command_template = parts[2].strip()
+                if "$SOURCE" not in command_template:
+                    command_template += " $SOURCE"
+                custom_conversions[parts[0].lower()] = (parts[1].strip(), command_template)
+    return custom_conversions
+
+
+def expand_asset_sources(sources):
+    """ Expand folders to the (sorted) list of files in them, keep files as they are. """
+    files = []
+    for s in sources:
+        s_path = s if isinstance(s, str) else s.get_abspath()
+        if isdir(s_path):
+            for root, dirs, names in walk(s_path):
+                dirs.sort()
+                files.extend(join(root, name) for name in sorted(names))
+        else:
+            # may not exist yet if it's the output of another builder (e.g. a DSO)
+            files.append(s_path)
+    return files
+
+
+def _make_recipe(env, template):
+    template = template.replace("$TARGETDIR", PH_TARGETDIR) \
+        .replace("$TARGET", PH_TARGET) \
+        .replace("$SOURCE", PH_SOURCE)
+    return env.subst(template)
+
+
+def plan_asset_job(env, src_file, tgt_dir, custom_conversions, tool_n64_dir):
+    """ Decide what to do with a single file based on conversion rules, or copy if no rule applies. """
+    file_name = basename(src_file)
+    file_lower = file_name.lower()
+
+    if file_lower in custom_conversions:
+        target_ext, command_template = custom_conversions[file_lower]
+        tgt_file = join(tgt_dir, file_name[:file_name.rfind(".")] + target_ext)
+        job = AssetJob(src_file, tgt_file, _make_recipe(env, command_template),
+                       f"Converting {src_file} to {tgt_file}")
+        if "${N64_MKFONT}" in command_template:
+            # the mkfont binary is special: it expects mksprite to be available at
+            # $N64_INST/bin/mksprite
+            # instead of patching the mkfont source code (which we can!), we just
+            # set the N64_INST variable to the right folder for this command.
+            # note that this only works because it doesn't access any compiler bins like mips64-elf-gcc
+            job.env_overrides["N64_INST"] = tool_n64_dir
+            job.description = f"(Font) Converting {src_file} to {tgt_file}"
+        return job
+    if file_lower.endswith(".xm"):
+        tgt_file = join(tgt_dir, file_name[:-3] + ".xm64")
+        template = "${N64_AUDIOCONV} -o $TARGET $SOURCE"
+    elif file_lower.endswith(".ym"):
+        tgt_file = join(tgt_dir, file_name[:-3] + ".ym64")
+        template = "${N64_AUDIOCONV} -o $TARGET $SOURCE"
+    elif file_lower.endswith(".wav"):
+        tgt_file = join(tgt_dir, file_name[:-4] + ".wav64")
+        template = "${N64_AUDIOCONV} --wav-compress 3 -o $TARGET $SOURCE"
+    elif file_lower.endswith(".png"):
+        tgt_file = join(tgt_dir, file_name[:-4] + ".sprite")
+        template = "${N64_MKSPRITE} -o $TARGETDIR $SOURCE"
+    else:
+        return AssetJob(src_file, join(tgt_dir, file_name),
+                        description=f"Placed: {src_file} -> {join(tgt_dir, file_name)}")
+    return AssetJob(src_file, tgt_file, _make_recipe(env, template),
+                    f"Converting {src_file} to {tgt_file}")
+
+
+def plan_asset_jobs(env, src_files, tgt_dir, tool_n64_dir="", warn=False):
+    """ The jobs for all asset files; only the emitter warns, the action plans the same again. """
+    custom_conversions = parse_conversion_rules(env)
+    jobs = {}
+    for src_file in src_files:
+        job = plan_asset_job(env, src_file, tgt_dir, custom_conversions, tool_n64_dir)
+        # the filesystem folder is flat: a later file with the same output name wins
+        if job.target in jobs:
+            if warn:
+                print(f"Warning: {job.source} overwrites {jobs[job.target].source} in {tgt_dir}")
+            del jobs[job.target]
+        jobs[job.target] = job
+    return list(jobs.values())
+
+
+# ioctl number of FICLONE on Linux, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+PASSTHROUGH_MODES = ("auto", "reflink", "hardlink", "copy")
+
+
+def _reflink(src, dst):
+    import fcntl  # not available on Windows
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def _stream_copy(src, dst, chunk_size=1 << 20):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        shutil.copyfileobj(fsrc, fdst, chunk_size)
+    shutil.copystat(src, dst)
+
+
+def place_file(src, dst, mode="auto"):
+    """
+    Put an unconverted asset into the filesystem folder without copying its bytes
+    if possible: reflink (copy-on-write clone) first, then a hardlink, then a
+    chunked copy. Returns the method that was used.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if mode in ("auto", "reflink") and hasattr(os, "uname") and os.uname().sysname == "Linux":
+        try:
+            _reflink(src, dst)
+            return "reflink"
+        except (OSError, ImportError):
+            pass
+    if mode in ("auto", "hardlink"):
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            pass  # other file system, or not supported
+    _stream_copy(src, dst)
+    return "copy"
+
+
+def hash_file(path, algo="sha256"):
+    h = hashlib.new(algo)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class AssetManifest:
+    """ Remembers, per output file, which input / recipe / tool produced it. """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {"version": MANIFEST_VERSION, "files": {}, "assets": {}}
+        self._used_files = set()
+        if isfile(path):
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+                if data.get("version") == MANIFEST_VERSION:
+                    self.data = data
+            except (OSError, ValueError):
+                pass  # a broken manifest just means everything is converted again
+
+    def file_hash(self, path):
+        """ Content hash of a file, re-using the last one if size and mtime are unchanged. """
+        self._used_files.add(path)
+        st = stat(path)
+        cached = self.data["files"].get(path)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached[2]
+        digest = hash_file(path)
+        self.data["files"][path] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def tool_hash(self, env, tool):
+        if not tool:
+            return ""
+        tool_path = env.WhereIs(tool)
+        return self.file_hash(tool_path) if tool_path else tool
+
+    def job_key(self, env, job):
+        h = hashlib.sha256()
+        h.update(json.dumps([
+            MANIFEST_VERSION,
+            job.recipe,
+            sorted(job.env_overrides),
+            self.file_hash(job.source),
+            self.tool_hash(env, job.tool),
+        ]).encode())
+        return h.hexdigest()
+
+    def is_current(self, job, key):
+        entry = self.data["assets"].get(basename(job.target))
+        if not entry or entry["key"] != key or not isfile(job.target):
+            return False
+        # a passthrough file must still be the same size as its source
+        return bool(job.recipe) or stat(job.target).st_size == stat(job.source).st_size
+
+    def record(self, job, key):
+        self.data["assets"][basename(job.target)] = {"key": key, "source": job.source}
+
+    def prune(self, jobs):
+        """ Forget assets that are not part of the build anymore. """
+        names = {basename(job.target) for job in jobs}
+        self.data["assets"] = {k: v for k, v in self.data["assets"].items() if k in names}
+        self.data["files"] = {k: v for k, v in self.data["files"].items() if k in self._used_files}
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=1, sort_keys=True)
+        replace(tmp_path, self.path)
+
+
+def manifest_path(tgt_dir):
+    # lives next to the filesystem folder, everything inside it ends up in the DFS
+    return tgt_dir.rstrip("/\\") + ".manifest.json"
+
+
+def remove_stale_outputs(tgt_dir, jobs):
+    """ Delete files left over from assets that were removed or renamed. """
+    expected = {basename(job.target) for job in jobs}
+    for name in listdir(tgt_dir):
+        if name not in expected:
+            path = join(tgt_dir, name)
+            if isdir(path):
+                shutil.rmtree(path)
+            else:
+                remove(path)
+            print(f"Removed stale asset {path}")
+
+
+@dataclass
+class AssetBatch:
+    """ Several jobs converted by a single invocation of a tool that accepts multiple inputs. """
+    jobs: list
+
+    @property
+    def cwd(self):
+        return self.jobs[0].cwd
+
+    @property
+    def recipe(self):
+        return self.jobs[0].recipe
+
+    @property
+    def env_overrides(self):
+        return self.jobs[0].env_overrides
+
+    @property
+    def description(self):
+        return f"Converting {len(self.jobs)} files in {self.cwd} to {dirname(self.jobs[0].target)}"
+
+    def command(self):
+        return self.recipe.replace(PH_TARGETDIR, dirname(self.jobs[0].target)) \
+            .replace(PH_SOURCE, " ".join(basename(job.source) for job in self.jobs))
+
+
+def _is_batchable(job, batch_tool):
+    # the inputs are appended to a single command line, so the recipe must only
+    # name the output folder and end with the (single) source file.
+    recipe = job.recipe
+    return (job.tool and basename(job.tool).split(".")[0] == batch_tool and
+            recipe.endswith(" " + PH_SOURCE) and recipe.count(PH_SOURCE) == 1 and
+            PH_TARGET not in recipe.replace(PH_TARGETDIR, "") and
+            " " not in basename(job.source))
+
+
+def group_asset_jobs(jobs, batch_tool, num_workers, max_batch=64):
+    """
+    Group jobs for batch_tool (mksprite) that share the same recipe, source folder and
+    output folder into AssetBatch units. Batches are split so that all workers get some.
+    Returns the units in the order of their first job.
+    """
+    groups = {}
+    units = []
+    for job in jobs:
+        if _is_batchable(job, batch_tool):
+            key = (job.recipe, job.cwd, dirname(job.target), tuple(sorted(job.env_overrides.items())))
+            if key not in groups:
+                groups[key] = []
+                units.append(groups[key])
+            groups[key].append(job)
+        else:
+            units.append(job)
+    result = []
+    for unit in units:
+        if not isinstance(unit, list):
+            result.append(unit)
+            continue
+        size = max(1, min(max_batch, -(-len(unit) // num_workers)))
+        for i in range(0, len(unit), size):
+            chunk = unit[i:i + size]
+            result.append(AssetBatch(chunk) if len(chunk) > 1 else chunk[0])
+    return result
+
+
+@dataclass
+class AssetResult:
+    job: AssetJob
+    returncode: int = 0
+    output: str = ""
+    cancelled: bool = False
+
+
+# pipes, redirects, command lists, variables, globs and subshells need a shell
+SHELL_CHARS = set("|&;<>()$`*?~%^\n")
+
+
+def needs_shell(command):
+    """ Whether a conversion command uses shell syntax instead of just naming a tool. """
+    return any(c in SHELL_CHARS for c in command)
+
+
+def split_command(command):
+    """ The argument list of a conversion command, split like a shell would. """
+    if os.name != "nt":
+        return shlex.split(command)
+    # Windows paths keep their backslashes, only the quotes around arguments go
+    return [a[1:-1] if len(a) > 1 and a[0] == a[-1] == '"' else a
+            for a in shlex.split(command, posix=False)]
+
+
+def _terminate(proc):
+    """ Stop a running conversion, for shell commands with everything the shell started. """
+    if not proc.n64_shell:
+        proc.terminate()
+    elif os.name == "nt":
+        subprocess.call(["taskkill", "/F", "/T", "/PID", str(proc.pid)],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+
+class AssetWorkerPool:
+    """
+    Runs asset jobs and batches on a bounded thread pool. The conversion tools are
+    separate processes, so threads are enough to keep all cores busy.
+    Output is printed in job order, no matter in which order the jobs finish.
+    After the first failure no new jobs are started and running tools are terminated.
+    """
+
+    def __init__(self, env, num_workers, passthrough_mode="auto"):
+        self.env = env
+        self.num_workers = max(1, num_workers)
+        self.passthrough_mode = passthrough_mode
+        self.verbose = int(ARGUMENTS.get("PIOVERBOSE", 0))
+        self.base_environ = {k: str(v) for k, v in env["ENV"].items()}
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._running = set()
+
+    def _run_command(self, unit):
+        environ = dict(self.base_environ, **unit.env_overrides)
+        jobs = unit.jobs if isinstance(unit, AssetBatch) else [unit]
+        with span(basename(jobs[0].target) + (f" (+{len(jobs) - 1})" if len(jobs) > 1 else ""),
+                  "asset", cmd=unit.command(),
+                  in_bytes=sum(os.path.getsize(job.source) for job in jobs)) as trace_args:
+            command = unit.command()
+            if needs_shell(command):
+                # through a shell in its own process group, cancel() terminates all of it
+                args = dict(args=command, shell=True)
+                if os.name != "nt":
+                    args["start_new_session"] = True
+            else:
+                # no shell in between, so that cancel() terminates the tool itself
+                argv = split_command(command)
+                if argv and not dirname(argv[0]):
+                    argv[0] = shutil.which(argv[0], path=environ.get("PATH")) or argv[0]
+                args = dict(args=argv)
+            with self._lock:
+                if self._stop.is_set():
+                    return None
+                try:
+                    proc = subprocess.Popen(cwd=unit.cwd, env=environ, stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT, **args)
+                except OSError as e:
+                    return 127, f"{command}: {e}\n"
+                proc.n64_shell = args.get("shell", False)
+                self._running.add(proc)
+            trace_args["child_pid"] = proc.pid
+            try:
+                output, _ = proc.communicate()
+            finally:
+                with self._lock:
+                    self._running.discard(proc)
+            trace_args["exit_code"] = proc.returncode
+            trace_args["out_bytes"] = sum(os.path.getsize(job.target) for job in jobs if isfile(job.target))
+        return proc.returncode, output.decode(errors="replace")
+
+    def _run_job(self, job):
+        if self._stop.is_set():
+            return AssetResult(job, cancelled=True)
+        if not job.recipe:
+            try:
+                place_file(job.source, job.target, self.passthrough_mode)
+            except OSError as e:
+                return AssetResult(job, 1, str(e) + "\n")
+            return AssetResult(job)
+        ret = self._run_command(job)
+        if ret is None:
+            return AssetResult(job, cancelled=True)
+        return AssetResult(job, ret[0], ret[1], cancelled=self._stop.is_set() and ret[0] != 0)
+
+    def _run_batch(self, batch):
+        ret = self._run_command(batch)
+        if ret is None:
+            return [AssetResult(job, cancelled=True) for job in batch.jobs]
+        returncode, output = ret
+        if returncode == 0 and all(isfile(job.target) for job in batch.jobs):
+            results = [AssetResult(job) for job in batch.jobs]
+            results[0].output = output
+            return results
+        if self._stop.is_set():
+            return [AssetResult(job, cancelled=True) for job in batch.jobs]
+        # fall back to one invocation per file, so that the error is reported
+        # for the file that actually caused it.
+        results = [self._run_job(job) for job in batch.jobs]
+        results[0].output = f"Batch conversion in {batch.cwd} failed, converting files one by one\n" + \
+            results[0].output
+        return results
+
+    def _run_unit(self, unit):
+        if isinstance(unit, AssetBatch):
+            return self._run_batch(unit)
+        return [self._run_job(unit)]
+
+    def cancel(self):
+        with self._lock:
+            self._stop.set()
+            for proc in self._running:
+                _terminate(proc)
+
+    def _print(self, result):
+        job = result.job
+        if result.cancelled:
+            return
+        print(job.command() if self.verbose and job.recipe else job.description)
+        if result.output:
+            print(result.output, end="" if result.output.endswith("\n") else "\n")
+        if result.returncode:
+            print(f"Error: converting {job.source} failed with exit code {result.returncode}")
+
+    def run(self, units, on_success=None):
+        """ Run all jobs / batches, returns the list of failed results. """
+        results = [None] * len(units)
+        printed = 0
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            futures = {executor.submit(self._run_unit, unit): i for i, unit in enumerate(units)}
+            for future in as_completed(futures):
+                i = futures[future]
+                if future.cancelled():
+                    jobs = units[i].jobs if isinstance(units[i], AssetBatch) else [units[i]]
+                    results[i] = [AssetResult(job, cancelled=True) for job in jobs]
+                else:
+                    results[i] = future.result()
+                for result in results[i]:
+                    if result.returncode and not result.cancelled:
+                        if not self._stop.is_set():
+                            for f in futures:
+                                f.cancel()
+                            self.cancel()
+                    elif not result.returncode and not result.cancelled and on_success:
+                        on_success(result.job)
+                while printed < len(results) and results[printed] is not None:
+                    for result in results[printed]:
+                        self._print(result)
+                    printed += 1
+        # cancelled futures never produce a result, print what's left in order
+        for unit_results in results[printed:]:
+            for result in unit_results or []:
+                self._print(result)
+        return [r for unit_results in results for r in unit_results or []
+                if r.returncode and not r.cancelled]
+
+
+def get_asset_jobs_count(env):
+    """ Number of parallel conversions: custom_asset_jobs, or what was given to `pio run -j`. """
+    jobs = str(env.GetProjectOption("custom_asset_jobs", "")).strip()
+    if jobs:
+        try:
+            return int(jobs)
+        except ValueError:
+            sys.stderr.write("Error: custom_asset_jobs must be a number, not '%s'\n" % jobs)
+            env.Exit(1)
+    return int(env.GetOption("num_jobs") or 1)
+
+
+def _tool_n64_dir(env):
+    return env.PioPlatform().get_package_dir("tool-n64") or ""
+
+
+def convert_assets_emitter(target, source, env):
+    """ Declare every converted / copied file as a target of ConvertAssets. """
+    tgt_dir = target[0].get_abspath()
+    src_files = expand_asset_sources(source)
+    jobs = plan_asset_jobs(env, src_files, tgt_dir, _tool_n64_dir(env), warn=True)
+    targets = [env.File(job.target) for job in jobs]
+    # a changed rule or an updated conversion tool must trigger the action as well,
+    # the manifest then decides which assets actually need to be converted.
+    env.Depends(targets, env.Value(str(env.GetProjectOption("custom_conversions", ""))))
+    for tool in sorted({job.tool for job in jobs if job.tool}):
+        tool_path = env.WhereIs(tool)
+        if tool_path:
+            env.Depends(targets, env.File(tool_path))
+    return targets, [env.File(p) for p in src_files]
+
+
+def get_asset_cache(env):
+    """ The cross-project cache for converted assets, or None if disabled. """
+    return get_build_cache(env, "assets", "custom_asset_cache", "custom_asset_cache_size", 2 * 1024 ** 3)
+
+
+def asset_cache_key(env, manifest, job):
+    # the recipe has placeholders instead of paths, so the key is the same in every project
+    h = hashlib.sha256()
+    h.update(json.dumps([
+        CACHE_VERSION,
+        job.recipe,
+        sorted(job.env_overrides),
+        manifest.file_hash(job.source),
+        env.PioPlatform().get_package_version("tool-n64") or "",
+        manifest.tool_hash(env, job.tool),
+    ]).encode())
+    return h.hexdigest()
+
+
+def asset_cache_stats(target, source, env):
+    cache = get_asset_cache(env)
+    if cache is None:
+        print("The asset cache is disabled (custom_asset_cache = no)")
+        return None
+    entries, size = cache.stats()
+    print(f"Asset cache: {cache.root}")
+    print(f"  {entries} entries, {format_size(size)} of {format_size(cache.max_size)} used")
+    return None
+
+
+def asset_cache_clean(target, source, env):
+    cache = get_asset_cache(env)
+    if cache is not None:
+        cache.clean()
+        print(f"Removed asset cache {cache.root}")
+    return None
+
+
+def convert_assets(target, source, env):
+    with span("ConvertAssets", "action"):
+        return _convert_assets(target, source, env)
+
+
+def _convert_assets(target, source, env):
+    tgt_dir = dirname(target[0].get_abspath())
+    makedirs(tgt_dir, exist_ok=True)
+    jobs = plan_asset_jobs(env, [s.get_abspath() for s in source], tgt_dir, _tool_n64_dir(env))
+    remove_stale_outputs(tgt_dir, jobs)
+
+    manifest = AssetManifest(manifest_path(tgt_dir))
+    keys = {}
+    pending = []
+    for job in jobs:
+        keys[job.target] = manifest.job_key(env, job)
+        if not manifest.is_current(job, keys[job.target]):
+            pending.append(job)
+            # an outdated output may be a hardlink to its source (placed as passthrough
+            # before a rule existed), writing into it would overwrite the project's asset
+            if job.recipe and os.path.lexists(job.target):
+                os.remove(job.target)
+
+    cache = get_asset_cache(env)
+    cache_keys = {}
+    if cache is not None:
+        still_pending = []
+        for job in pending:
+            if job.recipe:
+                cache_keys[job.target] = asset_cache_key(env, manifest, job)
+                if cache.get(cache_keys[job.target], {"output": job.target}):
+                    print(f"Restored {job.target} from asset cache")
+                    manifest.record(job, keys[job.target])
+                    continue
+            still_pending.append(job)
+        pending = still_pending
+
+    def on_success(job):
+        manifest.record(job, keys[job.target])
+        if job.target in cache_keys:
+            cache.put(cache_keys[job.target], {"output": job.target})
+
+    failures = []
+    try:
+        if pending:
+            passthrough_mode = str(env.GetProjectOption("custom_asset_passthrough", "auto")).strip().lower()
+            if passthrough_mode not in PASSTHROUGH_MODES:
+                print(f"Error: custom_asset_passthrough must be one of {', '.join(PASSTHROUGH_MODES)}")
+                return 1
+            pool = AssetWorkerPool(env, get_asset_jobs_count(env), passthrough_mode)
+            # mksprite accepts several input files, saves one process start per sprite
+            units = group_asset_jobs(pending, basename(env.subst("$N64_MKSPRITE")), pool.num_workers)
+            failures = pool.run(units, on_success=on_success)
+    finally:
+        manifest.prune(jobs)
+        manifest.save()
+        if cache is not None and cache_keys:
+            cache.trim()
+    if len(pending) < len(jobs):
+        print(f"{len(jobs) - len(pending)} of {len(jobs)} assets are up to date or restored from cache")
+    if failures:
+        print("Asset conversion failed for:")
+        for result in failures:
+            print(f"  {result.job.source} (exit code {result.returncode})")
+        return 1
+    return None  # Must return None to indicate success in SCons
@@ -0,0 +1,130 @@
+# Copyright 2024-present Maximilian Gerhardt <maximilian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# RDRAM budget of the program, checked once per linked ELF.
+#
+# On the N64 everything runs from RDRAM: code, read-only data, data and bss of the
+# main ELF all stay resident, so every allocated section counts. On top of that:
+# - the memory below the program (exception vectors, boot data),
+# - the reservations of custom_rdram_reserve (framebuffers, heap, DFS buffers, ...),
+# - the largest set of DSOs loaded at the same time (custom_dso_resident_sets,
+#   all DSOs at once if not set).
+# The sum has to fit into custom_rdram_size (4MB, or 8MB with the Expansion Pak).
+#
+# custom_section_budgets and custom_dso_budgets limit single sections of the main
+# ELF and the resident size of single DSOs. Both are lists of "name: size".
+#
+
+from os.path import basename, splitext
+
+from .elf import SHF_ALLOC, ElfFile
+from .options import get_list_of_lists_option, get_list_option, get_size_option, parse_size
+
+RDRAM_SIZES = (4 * 1024 ** 2, 8 * 1024 ** 2)
+# libdragon links the program to 0x80000400, below are the exception vectors
+LOW_MEMORY = 0x400
+
+
+class BudgetError(Exception):
+    pass
+
+
+def get_rdram_size(env):
+    """ custom_rdram_size: 4MB (default) or 8MB (Expansion Pak). """
+    try:
+        size = get_size_option(env, "custom_rdram_size", RDRAM_SIZES[0])
+    except ValueError as e:
+        raise BudgetError(f"custom_rdram_size: {e}")
+    if size not in RDRAM_SIZES:
+        raise BudgetError("custom_rdram_size must be 4MB or 8MB (Expansion Pak)")
+    return size
+
+
+def get_size_list_option(env, name):
+    """ A list option of "name: size" entries as {name: bytes}. """
+    sizes = {}
+    for item in get_list_option(env, name):
+        key, sep, value = item.rpartition(":")
+        if not sep or not key.strip():
+            raise BudgetError(f"{name}: expected 'name: size', got '{item}'")
+        try:
+            sizes[key.strip()] = parse_size(value)
+        except ValueError as e:
+            raise BudgetError(f"{name}: {e}")
+    return sizes
+
+
+def get_resident_sets(env, dso_names):
+    """ custom_dso_resident_sets: one set of DSO names (separated by commas or spaces) per line. """
+    sets = get_list_of_lists_option(env, "custom_dso_resident_sets")
+    if not sets:
+        return [sorted(dso_names)]
+    for dso_set in sets:
+        for name in dso_set:
+            if name not in dso_names:
+                raise BudgetError(f"custom_dso_resident_sets: unknown DSO '{name}'")
+    return sets
+
+
+def resident_sections(elf_path):
+    """ {section: size} of everything that is loaded into RDRAM. """
+    sections = {}
+    for s in ElfFile.read(elf_path).sections:
+        if s.flags & SHF_ALLOC and s.size:
+            sections[s.name] = sections.get(s.name, 0) + s.size
+    return sections
+
+
+def check_budgets(env, main_elf, dso_elfs):
+    """
+    Returns (breakdown lines, error lines). The build fails if there are errors.
+    dso_elfs are the ELFs of the DSOs, named like the .dso files.
+    """
+    rdram = get_rdram_size(env)
+    reservations = get_size_list_option(env, "custom_rdram_reserve")
+    section_budgets = get_size_list_option(env, "custom_section_budgets")
+    dso_budgets = get_size_list_option(env, "custom_dso_budgets")
+
+    sections = resident_sections(main_elf)
+    dsos = {splitext(basename(elf))[0] + ".dso": sum(resident_sections(elf).values()) for elf in dso_elfs}
+    for name in dso_budgets:
+        if name not in dsos:
+            raise BudgetError(f"custom_dso_budgets: unknown DSO '{name}'")
+    resident_set = max(get_resident_sets(env, set(dsos)), key=lambda s: sum(dsos[n] for n in s), default=[])
+
+    program = sum(sections.values())
+    entries = [("program", program)] + [(f"  {name}", size) for name, size in
+                                         sorted(sections.items(), key=lambda s: -s[1])]
+    entries.append(("low memory", LOW_MEMORY))
+    entries += [(f"reserved: {name}", size) for name, size in reservations.items()]
+    if resident_set:
+        entries.append((f"DSOs: {' '.join(resident_set)}", sum(dsos[n] for n in resident_set)))
+    total = program + LOW_MEMORY + sum(reservations.values()) + sum(dsos[n] for n in resident_set)
+
+    lines = [f"{name:<40} {size:>10} {size / rdram * 100:>6.1f}%" for name, size in entries]
+    lines.append(f"{'resident total':<40} {total:>10} {total / rdram * 100:>6.1f}% of {rdram // 1024 ** 2}MB RDRAM")
+
+    errors = []
+    if total > rdram:
+        errors.append(f"the resident size ({total} bytes) exceeds the RDRAM ({rdram} bytes) "
+                      f"by {total - rdram} bytes")
+    for name, budget in section_budgets.items():
+        size = sections.get(name, 0)
+        if size > budget:
+            errors.append(f"section {name} ({size} bytes) exceeds its budget of {budget} bytes")
+    for name, budget in dso_budgets.items():
+        if dsos[name] > budget:
+            errors.append(f"DSO {name} ({dsos[name]} bytes) exceeds its budget of {budget} bytes")
+    return lines, errors
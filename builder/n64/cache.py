@@ -0,0 +1,152 @@
+# Copyright 2024-present Maximilian Gerhardt <maximilian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Content-addressed file cache shared between projects, with a size cap.
+#
+# Every entry is a folder named after its key that holds one or more files.
+# The mtime of the entry's ".used" marker is bumped on every hit, so that the
+# least recently used entries are the first to go once the cache is too big.
+# Entries are written to a temporary folder and renamed into place, so several
+# builds can use the same cache at the same time.
+#
+
+import os
+import shutil
+import tempfile
+import time
+from os.path import getsize, isdir, isfile, join
+
+from .options import get_bool_option, get_size_option
+
+USED_MARKER = ".used"
+
+
+class FileCache:
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+
+    def _entry_dir(self, key):
+        return join(self.root, key[:2], key)
+
+    def _touch(self, entry_dir):
+        try:
+            os.utime(join(entry_dir, USED_MARKER), None)
+        except OSError:
+            pass
+
+    def get(self, key, files):
+        """ Copy the cached {name: destination} files out of the cache. Returns False on a miss. """
+        entry_dir = self._entry_dir(key)
+        if not isdir(entry_dir):
+            return False
+        try:
+            for name, dst in files.items():
+                shutil.copyfile(join(entry_dir, name), dst)
+        except OSError:
+            # incomplete or just evicted by another build
+            return False
+        self._touch(entry_dir)
+        return True
+
+    def path(self, key, name):
+        """ Path of a file in an entry, or None. Bumps the entry like get() does. """
+        entry_dir = self._entry_dir(key)
+        path = join(entry_dir, name)
+        if not isfile(path):
+            return None
+        self._touch(entry_dir)
+        return path
+
+    def put(self, key, files):
+        """ Store the {name: source} files under key. """
+        entry_dir = self._entry_dir(key)
+        if isdir(entry_dir):
+            self._touch(entry_dir)
+            return
+        os.makedirs(join(self.root, key[:2]), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=join(self.root, key[:2]))
+        try:
+            for name, src in files.items():
+                shutil.copyfile(src, join(tmp_dir, name))
+            with open(join(tmp_dir, USED_MARKER), "w"):
+                pass
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # somebody else was faster, or the disk is full. Either way not an error.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _entries(self):
+        if not isdir(self.root):
+            return
+        for bucket in os.listdir(self.root):
+            bucket_dir = join(self.root, bucket)
+            if not isdir(bucket_dir):
+                continue
+            for key in os.listdir(bucket_dir):
+                entry_dir = join(bucket_dir, key)
+                if key.startswith(".tmp-"):
+                    # left behind by an interrupted build
+                    if time.time() - os.path.getmtime(entry_dir) > 3600:
+                        shutil.rmtree(entry_dir, ignore_errors=True)
+                    continue
+                try:
+                    used = os.path.getmtime(join(entry_dir, USED_MARKER))
+                    size = sum(getsize(join(entry_dir, f)) for f in os.listdir(entry_dir))
+                except OSError:
+                    continue
+                yield entry_dir, used, size
+
+    def stats(self):
+        """ Returns (number of entries, total size in bytes). """
+        entries = list(self._entries())
+        return len(entries), sum(size for _, _, size in entries)
+
+    def trim(self):
+        """ Evict least recently used entries until the cache fits max_size. Returns evicted count. """
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        total = sum(size for _, _, size in entries)
+        evicted = 0
+        for entry_dir, _, size in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            evicted += 1
+        return evicted
+
+    def clean(self):
+        if isdir(self.root):
+            shutil.rmtree(self.root, ignore_errors=True)
+
+
+def get_build_cache(env, name, enable_option, size_option, default_size, enabled_by_default=True):
+    """
+    A FileCache in <core dir>/.cache/nintendon64/<name>, shared by all projects.
+    Returns None if disabled with `<enable_option> = no` (or not enabled with `= yes`).
+    """
+    if not get_bool_option(env, enable_option, enabled_by_default):
+        return None
+    root = str(env.GetProjectOption(enable_option + "_dir", "")).strip() or \
+        join(env.subst("$PROJECT_CORE_DIR"), ".cache", "nintendon64", name)
+    return FileCache(root, get_size_option(env, size_option, default_size))
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
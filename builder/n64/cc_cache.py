@@ -0,0 +1,432 @@
+# Copyright 2024-present Maximilian Gerhardt <maximilian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Compiler result cache, a small ccache for mips64-elf-gcc / g++.
+#
+# The compile commands (CCCOM, CXXCOM, ASPPCOM) are prefixed with this script,
+# which looks up the object file before running the compiler. It works like
+# ccache's direct mode: the first key covers the compiler binary, the arguments
+# and the source file, and leads to a manifest that lists the headers (taken from
+# the depfile gcc writes) of earlier compiles and the result they produced.
+# If all headers of an entry still have the same contents, the object file,
+# depfile and compiler output are restored from the cache.
+#
+# Paths under the old side of -ffile-prefix-map (the libdragon folder) are replaced
+# with a placeholder before hashing, so the framework objects are shared between
+# projects no matter where the framework package is installed. The same goes for
+# paths in the project folder (like the -I of its include folder), which refer to
+# the project the result is restored in.
+#
+# The cache is opt-in (custom_compiler_cache = yes) and limited to 2 GB by default
+# (custom_compiler_cache_size).
+#
+
+import atexit
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import abspath, dirname, getmtime, isfile, join, splitext
+
+if __name__ == "__main__":
+    # started as the compiler launcher: make the n64 package importable,
+    # without the n64 folder itself shadowing standard modules (trace, ...)
+    sys.path[0] = dirname(dirname(abspath(__file__)))
+
+from n64.cache import FileCache, format_size, get_build_cache
+from n64.depfiles import parse_depfile
+
+CACHE_VERSION = 2
+MAX_CANDIDATES = 16
+MANIFEST_MAX_AGE = 30 * 24 * 3600
+# touched when a compile stored a result / when the cache was trimmed
+STORED_MARKER = ".stored"
+TRIMMED_MARKER = ".trimmed"
+SOURCE_EXTENSIONS = {".c", ".cc", ".cpp", ".cxx", ".S", ".sx"}
+HEADER_EXTENSIONS = {".h", ".hh", ".hpp", ".hxx"}
+# options whose value is the next argument
+SEPARATE_VALUE_OPTIONS = {"-include", "-imacros", "-isystem", "-iquote", "-idirafter", "-I", "-D", "-U",
+                          "-x", "-MT", "-MQ", "-Xassembler", "-Xpreprocessor", "-aux-info"}
+# the result depends on the time of the compile
+UNCACHEABLE_MACROS = (b"__DATE__", b"__TIME__", b"__TIMESTAMP__")
+PREFIX_MAP_OPTIONS = ("-ffile-prefix-map=", "-fdebug-prefix-map=", "-fmacro-prefix-map=")
+# environment variables that change what the compiler does
+COMPILER_ENV = ("COMPILER_PATH", "GCC_EXEC_PREFIX", "CPATH", "C_INCLUDE_PATH",
+                "CPLUS_INCLUDE_PATH", "SOURCE_DATE_EPOCH")
+OUTPUT_PLACEHOLDER = "@@OUTPUT@@"
+PROJECT_PLACEHOLDER = "@@PROJECT@@"
+
+
+class Uncacheable(Exception):
+    pass
+
+
+def _expand_response_files(args, depth=0):
+    expanded = []
+    for a in args:
+        if a.startswith("@") and isfile(a[1:]) and depth < 8:
+            with open(a[1:], "r") as f:
+                expanded.extend(_expand_response_files(shlex.split(f.read(), posix=os.name != "nt"), depth + 1))
+        else:
+            expanded.append(a)
+    return expanded
+
+
+class Invocation:
+    """ A parsed `gcc -c` command line. """
+
+    def __init__(self, argv):
+        self.compiler = argv[0]
+        self.args = argv[1:]
+        self.output = None
+        self.source = None
+        self.depfile = None
+        self.wants_deps = False
+        self.prefix_maps = []
+        self.key_args = []
+        compile_only = False
+        language = None
+        args = _expand_response_files(self.args)
+        i = 0
+        while i < len(args):
+            a = args[i]
+            if a in ("-o", "-MF"):
+                if i + 1 >= len(args):
+                    raise Uncacheable("missing argument")
+                if a == "-o":
+                    self.output = args[i + 1]
+                else:
+                    self.depfile = args[i + 1]
+                i += 2
+                continue
+            if a in SEPARATE_VALUE_OPTIONS:
+                if i + 1 >= len(args):
+                    raise Uncacheable("missing argument")
+                if a == "-x":
+                    language = args[i + 1]
+                self.key_args += [a, args[i + 1]]
+                i += 2
+                continue
+            if a == "-c":
+                compile_only = True
+            elif a in ("-E", "-S", "-M", "-MM", "-", "-fprofile-generate") or a.startswith("-save-temps"):
+                raise Uncacheable(a)
+            elif a in ("-MD", "-MMD"):
+                self.wants_deps = True
+            elif a.startswith(PREFIX_MAP_OPTIONS):
+                old, _, new = a.split("=", 1)[1].partition("=")
+                self.prefix_maps.append((old.strip('"'), new.strip('"')))
+            elif not a.startswith("-") and (splitext(a)[1] in SOURCE_EXTENSIONS or (
+                    # precompiled headers
+                    splitext(a)[1] in HEADER_EXTENSIONS and language and language.endswith("-header"))):
+                if self.source is not None:
+                    raise Uncacheable("more than one source file")
+                self.source = a
+            self.key_args.append(a)
+            i += 1
+        if not compile_only or self.output is None or self.source is None:
+            raise Uncacheable("not a single compile")
+        if self.wants_deps and self.depfile is None:
+            # gcc puts it next to the output
+            self.depfile = splitext(self.output)[0] + ".d"
+
+        # longest prefix first, in both the native and the forward slash spelling
+        replacements = []
+        for old, new in self.prefix_maps:
+            for spelling in {old, old.replace("\\", "/")}:
+                replacements.append((spelling, "@@MAP:%s@@" % new))
+        self._mapped = sorted(replacements, key=lambda r: len(r[0]), reverse=True)
+        # the compiler runs in the project folder, its paths (-I of the include folder,
+        # headers in there, the depfile) refer to the project the result is restored in
+        project_dir = os.getcwd()
+        for spelling in {project_dir, project_dir.replace("\\", "/")}:
+            for sep in ("/", "\\"):
+                replacements.append((spelling + sep, PROJECT_PLACEHOLDER + sep))
+        self._replacements = sorted(replacements, key=lambda r: len(r[0]), reverse=True)
+        self._restore = {placeholder: old for old, placeholder in reversed(self._replacements)}
+
+    def normalize(self, text):
+        for old, placeholder in self._replacements:
+            text = text.replace(old, placeholder)
+        return text
+
+    def denormalize(self, text):
+        for placeholder, old in self._restore.items():
+            text = text.replace(placeholder, old)
+        return text
+
+    @property
+    def source_is_mapped(self):
+        source = abspath(self.source)
+        return any(source.startswith(old) for old, _ in self._mapped)
+
+
+class CompilerCache:
+
+    def __init__(self, root):
+        self.root = root
+        self.objects = FileCache(root, 0)
+        self._hashes = {}
+
+    def hash_file(self, path):
+        if path not in self._hashes:
+            h = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+            self._hashes[path] = h.hexdigest()
+        return self._hashes[path]
+
+    def compiler_hash(self, compiler):
+        """ Content hash of the compiler driver, remembered by path, size and mtime. """
+        path = shutil.which(compiler)
+        if path is None:
+            raise Uncacheable("compiler not found")
+        st = os.stat(path)
+        memo_key = f"{path}|{st.st_size}|{st.st_mtime_ns}"
+        memo_path = join(self.root, "compilers.json")
+        memo = _load_json(memo_path, {})
+        if memo_key not in memo:
+            memo[memo_key] = self.hash_file(path)
+            _save_json(memo_path, memo)
+        return memo[memo_key]
+
+    def manifest_path(self, key):
+        return join(self.root, "manifests", key[:2], key + ".json")
+
+    def direct_key(self, inv):
+        source_hash = self.hash_file(inv.source)
+        with open(inv.source, "rb") as f:
+            if any(m in f.read() for m in UNCACHEABLE_MACROS):
+                raise Uncacheable("time dependent source")
+        return hashlib.sha256(json.dumps([
+            CACHE_VERSION,
+            self.compiler_hash(inv.compiler),
+            [inv.normalize(a) for a in inv.key_args],
+            source_hash,
+            # the debug info of unmapped sources refers to the current directory
+            "" if inv.source_is_mapped else os.getcwd(),
+            [os.environ.get(name, "") for name in COMPILER_ENV],
+        ]).encode()).hexdigest()
+
+    def headers_match(self, inv, headers):
+        for path, digest in headers.items():
+            path = inv.denormalize(path)
+            try:
+                if self.hash_file(path) != digest:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def lookup(self, inv, key):
+        """ Restore the result of an earlier compile. Returns the compiler output or None. """
+        for candidate in _load_json(self.manifest_path(key), []):
+            if not self.headers_match(inv, candidate["headers"]):
+                continue
+            result = candidate["result"]
+            if not self.objects.get(result, {"object": inv.output}):
+                continue
+            if inv.wants_deps:
+                with open(self.objects.path(result, "depfile"), "r") as f:
+                    depfile = f.read()
+                with open(inv.depfile, "w") as f:
+                    f.write(inv.denormalize(depfile).replace(OUTPUT_PLACEHOLDER, inv.output))
+            with open(self.objects.path(result, "stderr"), "rb") as f:
+                return f.read()
+        return None
+
+    def store(self, inv, key, depfile_text, stderr):
+        deps = parse_depfile(depfile_text)
+        headers = {}
+        for dep in deps:
+            if os.path.normpath(dep) == os.path.normpath(inv.source):
+                continue
+            with open(dep, "rb") as f:
+                if any(m in f.read() for m in UNCACHEABLE_MACROS):
+                    return
+            headers[inv.normalize(dep)] = self.hash_file(dep)
+        result = hashlib.sha256(json.dumps([key, sorted(headers.items())]).encode()).hexdigest()
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.root)
+        try:
+            with open(join(tmp_dir, "depfile"), "w") as f:
+                f.write(inv.normalize(depfile_text.replace(inv.output, OUTPUT_PLACEHOLDER)))
+            with open(join(tmp_dir, "stderr"), "wb") as f:
+                f.write(inv.normalize(stderr.decode("utf-8", errors="surrogateescape"))
+                        .encode("utf-8", errors="surrogateescape"))
+            self.objects.put(result, {
+                "object": inv.output,
+                "depfile": join(tmp_dir, "depfile"),
+                "stderr": join(tmp_dir, "stderr"),
+            })
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        manifest_path = self.manifest_path(key)
+        candidates = [c for c in _load_json(manifest_path, []) if c["headers"] != headers]
+        candidates.insert(0, {"headers": headers, "result": result})
+        _save_json(manifest_path, candidates[:MAX_CANDIDATES])
+        _touch(join(self.root, STORED_MARKER))
+
+    def trim(self, max_size):
+        self.objects.max_size = max_size
+        self.objects.trim()
+        # manifests are tiny, they only go away when they haven't been used for a long time
+        manifests = join(self.root, "manifests")
+        now = time.time()
+        for folder, _, files in os.walk(manifests):
+            for name in files:
+                path = join(folder, name)
+                try:
+                    if now - getmtime(path) > MANIFEST_MAX_AGE:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+    def trim_if_stored(self, max_size):
+        """ trim(), but only if a compile stored a result since the last trim. """
+        try:
+            stored = getmtime(join(self.root, STORED_MARKER))
+        except OSError:
+            return
+        try:
+            if getmtime(join(self.root, TRIMMED_MARKER)) >= stored:
+                return
+        except OSError:
+            pass
+        # marked first, so results stored while trimming are seen by the next build
+        _touch(join(self.root, TRIMMED_MARKER))
+        self.trim(max_size)
+
+
+def _touch(path):
+    try:
+        with open(path, "a"):
+            pass
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+def _load_json(path, default):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def _save_json(path, data):
+    os.makedirs(dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=dirname(path))
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def run_compiler(argv):
+    result = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return result.returncode, result.stdout + result.stderr
+
+
+def compile_cached(cache_root, argv):
+    """ Returns the exit code of the (possibly skipped) compile. """
+    try:
+        inv = Invocation(argv)
+        cache = CompilerCache(cache_root)
+        key = cache.direct_key(inv)
+        output = cache.lookup(inv, key)
+    except (Uncacheable, OSError):
+        return subprocess.call(argv)
+    if output is not None:
+        sys.stderr.buffer.write(inv.denormalize(output.decode("utf-8", errors="surrogateescape"))
+                                .encode("utf-8", errors="surrogateescape"))
+        return 0
+
+    # a miss: have gcc write a depfile if the build didn't ask for one already
+    extra = []
+    depfile = inv.depfile
+    if not inv.wants_deps:
+        depfile = inv.output + ".ccache.d"
+        extra = ["-MD", "-MF", depfile]
+    started = time.time()
+    returncode, output = run_compiler(argv + extra)
+    sys.stderr.buffer.write(output)
+    if returncode != 0:
+        return returncode
+    try:
+        with open(depfile, "r") as f:
+            depfile_text = f.read()
+        # files changed while compiling, don't trust the result
+        if all(getmtime(d) < started - 1 for d in parse_depfile(depfile_text)):
+            cache.store(inv, key, depfile_text, output)
+    except (Uncacheable, OSError):
+        pass
+    finally:
+        if not inv.wants_deps and isfile(depfile):
+            os.remove(depfile)
+    return 0
+
+
+#
+# SCons side
+#
+
+def get_compiler_cache(env):
+    """ The FileCache holding the object files, or None if disabled. """
+    return get_build_cache(env, "compiler", "custom_compiler_cache", "custom_compiler_cache_size", 2 * 1024 ** 3,
+                           enabled_by_default=False)
+
+
+def enable_compiler_cache(env):
+    """ Run all C, C++ and preprocessed assembly compiles through the cache. """
+    cache = get_compiler_cache(env)
+    if cache is None:
+        return None
+    # other compile commands (precompiled headers) can use $COMPILER_LAUNCHER as well
+    env["COMPILER_LAUNCHER"] = '"$PYTHONEXE" "%s" "%s"' % (abspath(__file__), cache.root)
+    for com in ("CCCOM", "CXXCOM", "ASPPCOM"):
+        env[com] = "$COMPILER_LAUNCHER " + env[com]
+    # no-op builds store nothing, so they don't walk the cache either
+    atexit.register(CompilerCache(cache.root).trim_if_stored, cache.max_size)
+    return cache
+
+
+def compiler_cache_stats(target, source, env):
+    cache = get_compiler_cache(env)
+    if cache is None:
+        print("The compiler cache is disabled, enable it with custom_compiler_cache = yes")
+        return None
+    entries, size = cache.stats()
+    print(f"Compiler cache: {cache.root}")
+    print(f"  {entries} entries, {format_size(size)} of {format_size(cache.max_size)} used")
+    return None
+
+
+def compiler_cache_clean(target, source, env):
+    cache = get_compiler_cache(env)
+    if cache is not None:
+        cache.clean()
+        print(f"Removed compiler cache {cache.root}")
+    return None
+
+
+if __name__ == "__main__":
+    # cc_cache.py <cache folder> <compiler> <arguments...>
+    sys.exit(compile_cached(sys.argv[1], sys.argv[2:]))
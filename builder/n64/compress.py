@@ -0,0 +1,214 @@
+# Copyright 2024-present Maximilian Gerhardt <maximilian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Compression level of the main ELF (n64elfcompress) and the DSOs (n64dso).
+#
+# custom_elf_compression = 0 | 1 | 2 | 3 | auto (default: 1, what libdragon's
+# makefiles use). With auto, every level is tried in parallel and the one with the
+# lowest modeled loading time is taken, among the levels whose output fits into
+# custom_elf_compression_budget (if set). Loading time is modeled as reading the
+# compressed file through PI DMA (custom_elf_compression_pi_speed) plus
+# decompressing it at the speed of the level.
+#
+# The sizes every level produced are remembered by the hash of the input file, so
+# the search only runs again when the code changed. Otherwise only the chosen
+# level runs.
+#
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from os.path import basename, dirname, getsize, isfile, join
+
+from .options import get_size_option
+from .trace import span
+
+LEVELS = (0, 1, 2, 3)
+DEFAULT_LEVEL = 1
+# cartridge ROM through PI DMA with the default bus timing, bytes / s
+PI_DMA_SPEED = 5 * 1024 ** 2
+# decompression on the VR4300, bytes of output / s (level 0 is stored as is):
+# LZ4, aPLib and Shrinkler as used by libdragon
+DECOMPRESSION_SPEED = {1: 24 * 1024 ** 2, 2: 6 * 1024 ** 2, 3: 400 * 1024}
+CACHE_ENTRIES = 64
+# SCons runs the compress actions of the main ELF and the DSOs in parallel threads
+_cache_lock = threading.Lock()
+
+
+def get_compression_level(env):
+    """ custom_elf_compression as an int, or "auto". """
+    value = str(env.GetProjectOption("custom_elf_compression", "")).strip().lower()
+    if not value:
+        return DEFAULT_LEVEL
+    if value == "auto":
+        return value
+    if value.isdigit() and int(value) in LEVELS:
+        return int(value)
+    raise ValueError(f"custom_elf_compression must be one of 0, 1, 2, 3 or auto, not '{value}'")
+
+
+def loading_time(level, size, uncompressed_size, pi_speed=PI_DMA_SPEED):
+    """ Modeled seconds to load a file compressed with `level` from the cartridge. """
+    seconds = size / pi_speed
+    if level in DECOMPRESSION_SPEED:
+        seconds += uncompressed_size / DECOMPRESSION_SPEED[level]
+    return seconds
+
+
+def pick_level(sizes, budget=0, pi_speed=PI_DMA_SPEED):
+    """
+    The level with the lowest loading time among the ones that fit into budget
+    (0: no budget). If none fits, the one with the smallest output.
+    """
+    uncompressed = sizes.get(0, max(sizes.values()))
+    fitting = [level for level, size in sizes.items() if not budget or size <= budget]
+    if not fitting:
+        return min(sizes, key=lambda level: (sizes[level], level))
+    return min(fitting, key=lambda level: (loading_time(level, sizes[level], uncompressed, pi_speed), level))
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class LevelCache:
+    """ {input hash: {level: output size}} in a JSON file, the newest CACHE_ENTRIES entries. """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        sizes = self.entries.get(key)
+        return {int(level): size for level, size in sizes.items()} if sizes else None
+
+    def put(self, key, sizes):
+        with _cache_lock:
+            # merge with what other actions stored since this cache was loaded
+            self.entries = self._load()
+            self.entries.pop(key, None)
+            self.entries[key] = {str(level): size for level, size in sizes.items()}
+            while len(self.entries) > CACHE_ENTRIES:
+                del self.entries[next(iter(self.entries))]
+            os.makedirs(dirname(self.path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=dirname(self.path))
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp, self.path)
+
+
+def _run(env, cmd, cwd):
+    environ = {k: str(v) for k, v in env["ENV"].items()}
+    result = subprocess.run(env.subst(cmd), shell=True, cwd=cwd, env=environ,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return result.returncode, result.stdout.decode(errors="replace")
+
+
+def compress_elf_level(env, elf, level, out_dir):
+    """ Compress a stripped ELF with n64elfcompress into out_dir. Returns (path, exit code, output). """
+    out = join(out_dir, basename(elf))
+    # n64elfcompress works in place
+    shutil.copyfile(elf, out)
+    if level == 0:
+        return out, 0, ""
+    code, output = _run(env, '"$N64ELFCOMPRESS" -c %d "%s"' % (level, out), out_dir)
+    return out, code, output
+
+
+def compress_dso_level(env, elf, level, out_dir):
+    """ Turn a DSO's ELF into a .dso file with n64dso in out_dir. Returns (path, exit code, output). """
+    out = join(out_dir, basename(elf)[:-len(".elf")] + ".dso")
+    code, output = _run(env, '"$N64_DSO" -o "%s" -c %d "%s"' % (out_dir, level, basename(elf)), dirname(elf))
+    return out, code, output
+
+
+def compress(env, compress_level, src, dst, budget=0):
+    """
+    Compress src into dst with the level of custom_elf_compression, using
+    compress_level(env, src, level, out_dir). Returns an exit code.
+    """
+    level = get_compression_level(env)
+    tmp_root = tempfile.mkdtemp(prefix=".tmp-compress-", dir=dirname(dst))
+    try:
+        if level != "auto":
+            out, code, output = compress_level(env, src, level, tmp_root)
+        else:
+            out, code, output = _compress_auto(env, compress_level, src, tmp_root, budget)
+        if output:
+            print(output, end="" if output.endswith("\n") else "\n")
+        if code:
+            return code
+        os.replace(out, dst)
+        return 0
+    finally:
+        shutil.rmtree(tmp_root, ignore_errors=True)
+
+
+def _compress_auto(env, compress_level, src, tmp_root, budget):
+    pi_speed = get_size_option(env, "custom_elf_compression_pi_speed", PI_DMA_SPEED)
+    cache = LevelCache(join(env.subst("$BUILD_DIR"), "elf_compression.json"))
+    key = hash_file(src)
+    sizes = cache.get(key)
+    if sizes is not None:
+        level = pick_level(sizes, budget, pi_speed)
+        print(f"Compressing {basename(src)} with level {level} (found by an earlier search)")
+        return compress_level(env, src, level, tmp_root)
+
+    def run(level):
+        out_dir = join(tmp_root, str(level))
+        os.makedirs(out_dir)
+        with span(f"compress {basename(src)} -c {level}", "compress"):
+            return compress_level(env, src, level, out_dir)
+
+    jobs = min(len(LEVELS), int(env.GetOption("num_jobs") or 1))
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = dict(zip(LEVELS, executor.map(run, LEVELS)))
+    failed = [(level, r) for level, r in results.items() if r[1] or not isfile(r[0])]
+    if failed:
+        level, (out, code, output) = failed[0]
+        return out, code or 1, output
+    sizes = {level: getsize(out) for level, (out, _, _) in results.items()}
+    cache.put(key, sizes)
+    level = pick_level(sizes, budget, pi_speed)
+    uncompressed = sizes[0]
+    print(f"Compression levels for {basename(src)}:")
+    for lvl in LEVELS:
+        ms = loading_time(lvl, sizes[lvl], uncompressed, pi_speed) * 1000
+        print(f"  {'*' if lvl == level else ' '} level {lvl}: {sizes[lvl]:>9} bytes, ~{ms:.1f} ms to load")
+    if budget and sizes[level] > budget:
+        print(f"Warning! No compression level fits {basename(src)} into {budget} bytes")
+    return results[level]
+
+
+def get_compression_budget(env):
+    """ custom_elf_compression_budget in bytes, 0 if unset. """
+    return get_size_option(env, "custom_elf_compression_budget", 0)
+
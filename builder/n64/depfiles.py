@@ -0,0 +1,58 @@
+# Copyright 2024-present Maximilian Gerhardt <maximilian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Header dependencies from the depfiles gcc writes (-MMD -MF <object>.d).
+#
+# Instead of SCons' C scanner parsing every source and header in Python, the
+# objects get a target scanner that reads the depfile of their last compile. An
+# object without a depfile has never been built, so it is built anyway and
+# doesn't need to know its headers yet. Used by main.py and by the compiler cache
+# (which has no SCons), so this module must not import SCons.
+#
+
+import re
+from os.path import isabs, join
+
+DEPFILE_SUFFIX = ".d"
+
+
+def parse_depfile(text):
+    """ The prerequisites of the first rule in a make style depfile. """
+    text = text.replace("\\\r\n", " ").replace("\\\n", " ")
+    rule = text.split("\n", 1)[0]
+    # the target ends at the first colon that is followed by whitespace (C:\ is not)
+    match = re.search(r":(\s|$)", rule)
+    if match is None:
+        return []
+    deps = re.findall(r"(?:\\.|[^\s\\])+", rule[match.end():])
+    return [re.sub(r"\\([ #])", r"\1", d).replace("$$", "$") for d in deps]
+
+
+def scan_depfile(node, env, path):
+    """ SCons target scanner: the headers listed in the object's depfile. """
+    try:
+        with open(node.get_abspath() + DEPFILE_SUFFIX, "r") as f:
+            deps = parse_depfile(f.read())
+    except OSError:
+        return []
+    sources = {s.get_abspath() for s in node.sources}
+    # relative paths are relative to where gcc ran, the top folder of the build
+    top = env.fs.Top.get_abspath()
+    result = []
+    for dep in deps:
+        dep_node = env.File(dep if isabs(dep) else join(top, dep))
+        if dep_node.get_abspath() not in sources:
+            result.append(dep_node)
+    return result
@@ -0,0 +1,235 @@
+# Copyright 2024-present Maximilian Gerhardt <maximilian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# In-process handling of libdragon DFS images.
+#
+# A full image is always written by mkdfs, there is no DFS writer in Python: the
+# layout (entry order, padding) is whatever mkdfs does, and a writer here could drift
+# from it unnoticed. When only a few files changed, the image that mkdfs wrote last
+# time is parsed and the changed files are patched in place through a memory-mapped
+# file, as long as they kept their size. Then the layout and every size field stay
+# as mkdfs wrote them, and the patched image is byte for byte what mkdfs would write
+# for the new files. Files that changed their size make mkdfs write the whole image.
+#
+# custom_dfs_incremental = verify patches, then runs mkdfs anyway and fails the build
+# if the two images differ.
+#
+
+import json
+import mmap
+import struct
+from os import remove, replace, stat
+from os.path import isfile, relpath
+
+from .trace import span
+
+# next_entry, flags (4 bit type + 28 bit size), path, file_pointer
+DIRECTORY_ENTRY = struct.Struct(">II244sI")
+ROOT_FLAGS = 0xFFFFFFFF
+FLAGS_FILE = 0x0
+FLAGS_DIR = 0x1
+SIZE_MASK = 0x0FFFFFFF
+
+STATE_VERSION = 2
+
+
+class DfsFormatError(Exception):
+    pass
+
+
+class DfsFile:
+    def __init__(self, path, entry_offset, flags, data_offset):
+        self.path = path
+        self.entry_offset = entry_offset
+        self.flags = flags
+        self.data_offset = data_offset
+        self.slot = 0  # bytes available until the next structure in the image
+
+    @property
+    def size(self):
+        return self.flags & SIZE_MASK
+
+
+def _read_entry(buf, offset):
+    if offset < 0 or offset + DIRECTORY_ENTRY.size > len(buf):
+        raise DfsFormatError(f"directory entry at 0x{offset:x} is outside the image")
+    next_entry, flags, path, file_pointer = DIRECTORY_ENTRY.unpack_from(buf, offset)
+    name = path.split(b"\0", 1)[0]
+    try:
+        name = name.decode("ascii")
+    except UnicodeDecodeError:
+        raise DfsFormatError(f"invalid file name in entry at 0x{offset:x}")
+    return next_entry, flags, name, file_pointer
+
+
+def read_dfs_index(buf):
+    """ Parse the directory tree of a DFS image into {path: DfsFile}. """
+    _, root_flags, _, first_entry = _read_entry(buf, 0)
+    if root_flags != ROOT_FLAGS:
+        raise DfsFormatError("no DFS root sector found")
+    files = {}
+    structure_offsets = {0}
+    visited = set()
+    pending = [("", first_entry)]
+    while pending:
+        prefix, offset = pending.pop()
+        while offset:
+            if offset in visited:
+                raise DfsFormatError(f"directory loop at 0x{offset:x}")
+            visited.add(offset)
+            structure_offsets.add(offset)
+            next_entry, flags, name, file_pointer = _read_entry(buf, offset)
+            entry_type = flags >> 28
+            if entry_type == FLAGS_DIR:
+                pending.append((prefix + name + "/", file_pointer))
+            elif entry_type == FLAGS_FILE:
+                f = DfsFile(prefix + name, offset, flags, file_pointer)
+                if file_pointer + f.size > len(buf):
+                    raise DfsFormatError(f"{f.path} extends past the end of the image")
+                files[f.path] = f
+                structure_offsets.add(file_pointer)
+            else:
+                raise DfsFormatError(f"unknown entry type {entry_type} at 0x{offset:x}")
+            offset = next_entry
+    # a file may grow up to the start of whatever follows it in the image
+    ordered = sorted(structure_offsets | {len(buf)})
+    for f in files.values():
+        following = [o for o in ordered if o > f.data_offset]
+        f.slot = following[0] - f.data_offset if following else 0
+    return files
+
+
+def patch_dfs_image(image_path, changed):
+    """
+    Replace the contents of the files in `changed` ({dfs path: host file}) in place.
+    Returns False, leaving the image untouched, if the image can't be parsed or
+    one of the new files has a different size than the old one.
+    """
+    with open(image_path, "r+b") as fp:
+        with mmap.mmap(fp.fileno(), 0) as mm:
+            try:
+                index = read_dfs_index(mm)
+            except DfsFormatError as e:
+                print(f"Can't patch {image_path} in place: {e}")
+                return False
+            patches = []
+            for path, src in changed.items():
+                entry = index.get(path)
+                if entry is None:
+                    return False
+                with open(src, "rb") as f:
+                    data = f.read()
+                # another size could change the padding mkdfs puts behind the file
+                if len(data) != entry.size or len(data) > entry.slot:
+                    return False
+                patches.append((entry, data))
+            for entry, data in patches:
+                mm[entry.data_offset:entry.data_offset + len(data)] = data
+                print(f"Patched {entry.path} in {image_path}")
+            mm.flush()
+    return True
+
+
+def _load_state(path):
+    if isfile(path):
+        try:
+            with open(path, "r") as f:
+                state = json.load(f)
+            if state.get("version") == STATE_VERSION:
+                return state
+        except (OSError, ValueError):
+            pass
+    return None
+
+
+def _save_state(path, state):
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    replace(path + ".tmp", path)
+
+
+def build_dfs(target, source, env):
+    """
+    DataToDfs action: patch the existing image if possible, otherwise run mkdfs.
+    Sources are the files of the filesystem folder.
+    """
+    with span("DataToDfs " + target[0].name, "action"):
+        return _build_dfs(target, source, env)
+
+
+def _mkdfs(env, image, fs_dir):
+    return env.Execute(env.VerboseAction(" ".join([
+        '"$MKDFSTOOL"',
+        '"%s"' % image,
+        '"%s"' % fs_dir
+    ]), "Building file system image from '%s' directory to %s" % (fs_dir, image)))
+
+
+def _verify_patched(env, image, fs_dir):
+    """ Compare the patched image with what mkdfs writes, returns an exit code. """
+    reference = image + ".verify"
+    result = _mkdfs(env, reference, fs_dir)
+    if result:
+        return result
+    try:
+        with open(image, "rb") as a, open(reference, "rb") as b:
+            patched, written = a.read(), b.read()
+    finally:
+        remove(reference)
+    if patched != written:
+        diff = next((i for i, (x, y) in enumerate(zip(patched, written)) if x != y),
+                    min(len(patched), len(written)))
+        print(f"Error: the patched {image} differs from the mkdfs image at offset 0x{diff:x} "
+              f"({len(patched)} / {len(written)} bytes)")
+        return 1
+    print(f"Verified patched {image} against mkdfs")
+    return None
+
+
+def _build_dfs(target, source, env):
+    image = target[0].get_abspath()
+    fs_dir = source[0].get_dir().get_abspath()
+    state_path = image + ".state.json"
+    # SCons already knows the content signature of every source file
+    files = {relpath(s.get_abspath(), fs_dir).replace("\\", "/"): s for s in source}
+    signatures = {path: s.get_csig() for path, s in files.items()}
+
+    incremental = str(env.GetProjectOption("custom_dfs_incremental", "yes")).strip().lower()
+    state = _load_state(state_path)
+    if (incremental in ("yes", "true", "1", "on", "verify") and state and isfile(image)
+            and set(state["files"]) == set(files)):
+        st = stat(image)
+        if state["image"] == [st.st_size, st.st_mtime_ns]:
+            changed = {path: files[path].get_abspath() for path in files
+                       if state["files"][path] != signatures[path]}
+            if not changed:
+                return None
+            if patch_dfs_image(image, changed):
+                if incremental == "verify":
+                    result = _verify_patched(env, image, fs_dir)
+                    if result:
+                        return result
+                st = stat(image)
+                _save_state(state_path, {"version": STATE_VERSION, "files": signatures,
+                                         "image": [st.st_size, st.st_mtime_ns]})
+                return None
+
+    result = _mkdfs(env, image, fs_dir)
+    if result:
+        return result
+    st = stat(image)
+    _save_state(state_path, {"version": STATE_VERSION, "files": signatures,
+                             "image": [st.st_size, st.st_mtime_ns]})
+    return None
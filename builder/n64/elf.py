@@ -0,0 +1,267 @@
+# Copyright 2024-present Maximilian Gerhardt <maximilian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Minimal ELF32 reader / writer, enough to replace the objcopy / ld -relocatable
+# round trips of the RSP ucode build: read sections and symbols of a linked ELF,
+# and write a relocatable object that carries binary blobs in its .data section,
+# like `objcopy -I binary -O elf32-bigmips -B mips4300` followed by `ld -r` does.
+#
+
+import struct
+
+EM_MIPS = 8
+ET_REL = 1
+EV_CURRENT = 1
+# what objcopy -B mips4300 puts into e_flags (E_MIPS_ARCH_3)
+EF_MIPS_ARCH_3 = 0x20000000
+
+SHT_NULL = 0
+SHT_PROGBITS = 1
+SHT_SYMTAB = 2
+SHT_STRTAB = 3
+SHT_NOBITS = 8
+SHT_REL = 9
+
+SHF_WRITE = 0x1
+SHF_ALLOC = 0x2
+SHF_EXECINSTR = 0x4
+
+SHN_UNDEF = 0
+SHN_ABS = 0xFFF1
+SHN_COMMON = 0xFFF2
+
+STB_LOCAL = 0
+STB_GLOBAL = 1
+STB_WEAK = 2
+STT_NOTYPE = 0
+STT_OBJECT = 1
+STT_FUNC = 2
+STT_SECTION = 3
+
+
+class ElfError(Exception):
+    pass
+
+
+class Section:
+    def __init__(self, index, name, sh_type, flags, addr, offset, size, link, info, align, entsize):
+        self.index = index
+        self.name = name
+        self.type = sh_type
+        self.flags = flags
+        self.addr = addr
+        self.offset = offset
+        self.size = size
+        self.link = link
+        self.info = info
+        self.align = align
+        self.entsize = entsize
+
+
+class Symbol:
+    def __init__(self, name, value, size, info, other, shndx):
+        self.name = name
+        self.value = value
+        self.size = size
+        self.bind = info >> 4
+        self.type = info & 0xF
+        self.other = other
+        self.shndx = shndx
+
+
+class ElfFile:
+    """ Read-only view of an ELF32 file (either endianness). """
+
+    def __init__(self, data):
+        if data[:4] != b"\x7fELF":
+            raise ElfError("not an ELF file")
+        if data[4] != 1:
+            raise ElfError("only ELF32 is supported")
+        self.data = data
+        self.endian = ">" if data[5] == 2 else "<"
+        (self.type, self.machine, _, self.entry, _, self.shoff, self.flags, _, _, _,
+         shentsize, shnum, shstrndx) = struct.unpack_from(self.endian + "HHIIIIIHHHHHH", data, 16)
+        self.sections = []
+        raw = [struct.unpack_from(self.endian + "IIIIIIIIII", data, self.shoff + i * shentsize)
+               for i in range(shnum)]
+        shstr = raw[shstrndx] if shnum else None
+        for i, (name, sh_type, flags, addr, offset, size, link, info, align, entsize) in enumerate(raw):
+            self.sections.append(Section(i, self._string(shstr[4], name) if shstr else "",
+                                         sh_type, flags, addr, offset, size, link, info, align, entsize))
+        self._symbols = None
+
+    @classmethod
+    def read(cls, path):
+        with open(path, "rb") as f:
+            return cls(f.read())
+
+    def _string(self, offset, index):
+        end = self.data.index(b"\0", offset + index)
+        return self.data[offset + index:end].decode("utf-8", errors="replace")
+
+    def section(self, name):
+        for s in self.sections:
+            if s.name == name:
+                return s
+        return None
+
+    def section_data(self, name_or_section):
+        s = name_or_section if isinstance(name_or_section, Section) else self.section(name_or_section)
+        if s is None or s.type == SHT_NOBITS:
+            return b""
+        return self.data[s.offset:s.offset + s.size]
+
+    @property
+    def symbols(self):
+        if self._symbols is None:
+            self._symbols = []
+            symtab = next((s for s in self.sections if s.type == SHT_SYMTAB), None)
+            if symtab is not None:
+                strtab = self.sections[symtab.link]
+                for off in range(symtab.offset + 16, symtab.offset + symtab.size, 16):
+                    name, value, size, info, other, shndx = struct.unpack_from(
+                        self.endian + "IIIBBH", self.data, off)
+                    self._symbols.append(Symbol(self._string(strtab.offset, name),
+                                                value, size, info, other, shndx))
+        return self._symbols
+
+    def relocation_addresses(self):
+        """ Addresses patched by relocations that were kept in a linked file (--emit-relocs). """
+        addresses = set()
+        for s in self.sections:
+            if s.type == SHT_REL and s.info < len(self.sections) and self.sections[s.info].flags & SHF_ALLOC:
+                for off in range(s.offset, s.offset + s.size, 8):
+                    addresses.add(struct.unpack_from(self.endian + "I", self.data, off)[0])
+        return addresses
+
+    def section_name(self, shndx):
+        if shndx == SHN_ABS:
+            return "*ABS*"
+        if shndx == SHN_UNDEF:
+            return "*UND*"
+        if shndx == SHN_COMMON:
+            return "*COM*"
+        return self.sections[shndx].name if shndx < len(self.sections) else "?"
+
+
+def _align(value, alignment):
+    return (value + alignment - 1) & ~(alignment - 1)
+
+
+class _StringTable:
+    def __init__(self):
+        self.data = bytearray(b"\0")
+        self.offsets = {"": 0}
+
+    def add(self, s):
+        if s not in self.offsets:
+            self.offsets[s] = len(self.data)
+            self.data += s.encode() + b"\0"
+        return self.offsets[s]
+
+
+def write_blob_object(path, blobs, alignment=8, e_flags=EF_MIPS_ARCH_3):
+    """
+    Write a big-endian MIPS relocatable object with all blobs in one .data section.
+    blobs is a list of (symbol prefix, bytes); every blob is aligned to `alignment`
+    and gets <prefix>_start, <prefix>_end and the absolute <prefix>_size symbols.
+    """
+    data = bytearray()
+    symbols = []  # name, value, shndx
+    for prefix, blob in blobs:
+        start = _align(len(data), alignment)
+        data += bytes(start - len(data)) + blob
+        symbols += [
+            (prefix + "_start", start, 1),
+            (prefix + "_end", start + len(blob), 1),
+            (prefix + "_size", len(blob), SHN_ABS),
+        ]
+
+    strtab = _StringTable()
+    symtab = bytearray(16)  # null symbol
+    symtab += struct.pack(">IIIBBH", 0, 0, 0, (STB_LOCAL << 4) | STT_SECTION, 0, 1)
+    for name, value, shndx in symbols:
+        symtab += struct.pack(">IIIBBH", strtab.add(name), value, 0, (STB_GLOBAL << 4) | STT_NOTYPE, 0, shndx)
+
+    shstrtab = _StringTable()
+    names = [shstrtab.add(n) for n in ("", ".data", ".symtab", ".strtab", ".shstrtab")]
+
+    ehdr_size = 52
+    data_off = _align(ehdr_size, 16)
+    symtab_off = _align(data_off + len(data), 4)
+    strtab_off = symtab_off + len(symtab)
+    shstrtab_off = strtab_off + len(strtab.data)
+    shoff = _align(shstrtab_off + len(shstrtab.data), 4)
+
+    sections = [
+        (names[0], SHT_NULL, 0, 0, 0, 0, 0, 0, 0),
+        (names[1], SHT_PROGBITS, SHF_WRITE | SHF_ALLOC, data_off, len(data), 0, 0, alignment, 0),
+        # sh_info: index of the first global symbol
+        (names[2], SHT_SYMTAB, 0, symtab_off, len(symtab), 3, 2, 4, 16),
+        (names[3], SHT_STRTAB, 0, strtab_off, len(strtab.data), 0, 0, 1, 0),
+        (names[4], SHT_STRTAB, 0, shstrtab_off, len(shstrtab.data), 0, 0, 1, 0),
+    ]
+
+    out = bytearray()
+    out += b"\x7fELF" + bytes([1, 2, EV_CURRENT, 0]) + bytes(8)
+    out += struct.pack(">HHIIIIIHHHHHH", ET_REL, EM_MIPS, EV_CURRENT, 0, 0, shoff, e_flags,
+                       ehdr_size, 0, 0, 40, len(sections), 4)
+    out += bytes(data_off - len(out)) + data
+    out += bytes(symtab_off - len(out)) + symtab + strtab.data + shstrtab.data
+    out += bytes(shoff - len(out))
+    for name, sh_type, flags, offset, size, link, info, align, entsize in sections:
+        out += struct.pack(">IIIIIIIIII", name, sh_type, flags, 0, offset, size, link, info, align, entsize)
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def compare_blob_objects(path_a, path_b):
+    """
+    Blob-for-blob comparison of two objects carrying blobs: every <prefix>_start,
+    _end and _size symbol must exist in both, with the same value, and the bytes
+    between _start and _end must be identical. Anything else the toolchain put
+    into an object (.reginfo, padding between blobs, ...) is not compared.
+    Returns a list of human readable differences (empty if equivalent).
+    """
+    a, b = ElfFile.read(path_a), ElfFile.read(path_b)
+    diffs = []
+
+    def blob_symbols_of(elf):
+        return {s.name: s for s in elf.symbols if s.bind != STB_LOCAL and
+                s.name.endswith(("_start", "_end", "_size"))}
+
+    def blob_of(elf, syms, prefix):
+        start, end = syms[prefix + "_start"], syms.get(prefix + "_end")
+        if end is None or end.shndx != start.shndx:
+            return None
+        return elf.section_data(elf.section_name(start.shndx))[start.value:end.value]
+
+    syms_a, syms_b = blob_symbols_of(a), blob_symbols_of(b)
+    for name in sorted(set(syms_a) | set(syms_b)):
+        sa, sb = syms_a.get(name), syms_b.get(name)
+        if sa is None or sb is None:
+            diffs.append(f"{name}: only in {path_a if sb is None else path_b}")
+            continue
+        sec_a, sec_b = a.section_name(sa.shndx), b.section_name(sb.shndx)
+        if (sec_a, sa.value) != (sec_b, sb.value):
+            diffs.append(f"{name}: {sec_a}+0x{sa.value:x} != {sec_b}+0x{sb.value:x}")
+    for name in sorted(set(syms_a) & set(syms_b)):
+        if name.endswith("_start"):
+            prefix = name[:-len("_start")]
+            if blob_of(a, syms_a, prefix) != blob_of(b, syms_b, prefix):
+                diffs.append(f"{prefix}: contents differ")
+    if a.flags != b.flags:
+        diffs.append(f"e_flags: 0x{a.flags:08x} != 0x{b.flags:08x}")
+    return diffs
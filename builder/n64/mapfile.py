@@ -0,0 +1,112 @@
+# Copyright 2024-present Maximilian Gerhardt <maximilian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Reader for the map files GNU ld writes with -Map.
+#
+# Only the "Linker script and memory map" part is read, line by line: every input
+# section that went into the output with its address, size and the object file
+# (or archive member) it came from, and the symbols ld lists for it. Long section
+# names make ld put the address on the next line, both forms are handled.
+#
+
+import re
+from bisect import bisect_right
+
+MEMORY_MAP_START = "Linker script and memory map"
+# " .text.foo  0x0000000080001000  0x40 path/to/file.o" (name may be on its own line)
+INPUT_SECTION = re.compile(r"^ (\.?[^\s*]\S*)?\s+0x([0-9a-fA-F]+)\s+0x([0-9a-fA-F]+)\s+(\S.*)$")
+SECTION_NAME_ONLY = re.compile(r"^ (\.?[^\s*]\S*)$")
+# "                0x0000000080001000                symbol_name"
+SYMBOL = re.compile(r"^\s+0x([0-9a-fA-F]+)\s+([A-Za-z_.$][\w.$]*)\s*$")
+ARCHIVE_MEMBER = re.compile(r"^(.*)\(([^()]+)\)$")
+
+
+class InputSection:
+    __slots__ = ("name", "address", "size", "file", "symbols")
+
+    def __init__(self, name, address, size, file):
+        self.name = name
+        self.address = address
+        self.size = size
+        self.file = file
+        self.symbols = []  # (address, name) as listed by ld
+
+    @property
+    def archive(self):
+        """ Archive the section came from ("" for plain object files). """
+        m = ARCHIVE_MEMBER.match(self.file)
+        return m.group(1) if m else ""
+
+    @property
+    def object(self):
+        m = ARCHIVE_MEMBER.match(self.file)
+        return m.group(2) if m else self.file
+
+    def symbol_sizes(self):
+        """ [(name, size)]: every symbol spans up to the next one or the end of the section. """
+        symbols = sorted(s for s in self.symbols if self.address <= s[0] < self.address + self.size)
+        ends = [a for a, _ in symbols[1:]] + [self.address + self.size]
+        return [(name, end - address) for (address, name), end in zip(symbols, ends)]
+
+
+def input_sections(path):
+    """ Yield an InputSection (with its symbols) for every non-empty input section in the map file. """
+    in_map = False
+    pending_name = None
+    current = None
+    with open(path, "r", errors="replace") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not in_map:
+                in_map = line.startswith(MEMORY_MAP_START)
+                continue
+            m = SYMBOL.match(line)
+            if m:
+                if current is not None:
+                    current.symbols.append((int(m.group(1), 16), m.group(2)))
+                continue
+            # anything else ends the symbol list of the current section
+            if current is not None:
+                yield current
+                current = None
+            m = INPUT_SECTION.match(line)
+            if m:
+                name = m.group(1) or pending_name
+                pending_name = None
+                size = int(m.group(3), 16)
+                # "*fill*" lines and output sections (no file) don't match, load addresses do
+                if name and size and not m.group(4).startswith("load address"):
+                    current = InputSection(name, int(m.group(2), 16), size, m.group(4).strip())
+                continue
+            m = SECTION_NAME_ONLY.match(line)
+            pending_name = m.group(1) if m else None
+    if current is not None:
+        yield current
+
+
+class AddressIndex:
+    """ Find the input section (and so the object file) an address belongs to. """
+
+    def __init__(self, sections):
+        self.sections = sorted((s for s in sections if s.address), key=lambda s: s.address)
+        self.starts = [s.address for s in self.sections]
+
+    def find(self, address):
+        i = bisect_right(self.starts, address) - 1
+        if i >= 0:
+            s = self.sections[i]
+            if s.address <= address < s.address + s.size:
+                return s
+        return None
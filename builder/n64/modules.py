@@ -0,0 +1,192 @@
+# Copyright 2024-present Maximilian Gerhardt <maximilian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# libdragon modules: every top-level folder of src/ (audio, rdpq, GL, ...) is a module,
+# the files directly in src/ form the "core" module that is always built.
+#
+# For `custom_libdragon_modules = auto`, a module is needed when the project's sources
+# mention a function it defines, or a function / macro of one of its headers. Modules
+# needed by needed modules are added until nothing changes. This is a textual scan,
+# so it errs on the side of building a module too many.
+#
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+from os.path import basename, dirname, getmtime, isdir, join, relpath, splitext
+
+CORE = "core"
+INDEX_VERSION = 1
+
+IDENTIFIER = re.compile(rb"\b[A-Za-z_]\w*\b")
+# a non-static function definition at the start of a line
+FUNCTION_DEFINITION = re.compile(
+    rb"^(?!static\b)[A-Za-z_][\w \t\*]*?\b([A-Za-z_]\w*)[ \t]*\([^;{}]*\)\s*\{", re.M)
+# what a header offers: macros, and functions declared or defined at the start of a line
+# (calls inside inline functions are indented and don't count)
+HEADER_NAME = re.compile(
+    rb"^[ \t]*#[ \t]*define[ \t]+([A-Za-z_]\w*)|^[A-Za-z_][\w \t\*]*?\b([A-Za-z_]\w*)[ \t]*\(", re.M)
+COMMENT = re.compile(rb"/\*.*?\*/|//[^\n]*", re.S)
+C_KEYWORDS = {
+    b"if", b"for", b"while", b"switch", b"return", b"sizeof", b"defined", b"typeof", b"__typeof__",
+    b"__attribute__", b"alignof", b"_Alignof", b"_Static_assert", b"static_assert", b"__asm__",
+    b"asm", b"case", b"do", b"else", b"_Generic", b"__builtin_expect", b"offsetof",
+}
+USER_EXTENSIONS = {".c", ".cpp", ".cc", ".cxx", ".h", ".hpp", ".hh", ".S", ".inc"}
+
+
+def module_of(src):
+    parts = src.replace("\\", "/").split("/")
+    return parts[0] if len(parts) > 1 else CORE
+
+
+def group_modules(srcs):
+    """ {module: [sources]} """
+    modules = {}
+    for src in srcs:
+        modules.setdefault(module_of(src), []).append(src)
+    return modules
+
+
+def _read(path):
+    try:
+        with open(path, "rb") as f:
+            return COMMENT.sub(b" ", f.read())
+    except OSError:
+        return b""
+
+
+def _files(folder, extensions):
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in files:
+            if splitext(name)[1] in extensions:
+                yield join(root, name)
+
+
+def _header_owner(header, modules, stems):
+    """ The module a header of the include/ folder belongs to, or None. """
+    parts = header.split("/")
+    if len(parts) > 1 and parts[0] in modules:
+        return parts[0]
+    stem = splitext(parts[-1])[0]
+    if stem in stems:
+        return stems[stem]
+    for module in modules:
+        if module != CORE and stem.lower().startswith(module.lower()):
+            return module
+    return None
+
+
+def build_module_index(framework_dir, srcs):
+    """ {module: {"provides": [identifiers], "uses": [identifiers]}} """
+    src_dir = join(framework_dir, "src")
+    include_dir = join(framework_dir, "include")
+    modules = group_modules(srcs)
+    stems = {}
+    for module, files in modules.items():
+        for f in files:
+            stems.setdefault(splitext(basename(f))[0], module)
+
+    provides = {m: set() for m in modules}
+    uses = {m: set() for m in modules}
+    for module, files in modules.items():
+        for f in files:
+            text = _read(join(src_dir, f))
+            uses[module].update(IDENTIFIER.findall(text))
+            provides[module].update(FUNCTION_DEFINITION.findall(text))
+        if module != CORE and isdir(join(src_dir, module)):
+            for header in _files(join(src_dir, module), {".h"}):
+                provides[module].update(_header_names(_read(header)))
+    if isdir(include_dir):
+        for header in _files(include_dir, {".h", ".hpp"}):
+            owner = _header_owner(relpath(header, include_dir).replace(os.sep, "/"), modules, stems)
+            if owner is not None:
+                provides[owner].update(_header_names(_read(header)))
+
+    # a name offered by more than one module doesn't tell which one is used
+    seen = {}
+    for module, names in provides.items():
+        for name in names:
+            seen[name] = seen.get(name, 0) + 1
+    return {
+        module: {
+            "provides": sorted(n.decode() for n in provides[module] if seen[n] == 1 and n not in C_KEYWORDS),
+            "uses": sorted(n.decode() for n in uses[module]),
+        }
+        for module in modules
+    }
+
+
+def _header_names(text):
+    return {a or b for a, b in HEADER_NAME.findall(text)}
+
+
+def load_module_index(framework_dir, srcs, revision, cache_path):
+    """ build_module_index(), remembered in cache_path until a framework file changes. """
+    h = hashlib.sha256(json.dumps([INDEX_VERSION, revision, framework_dir, sorted(srcs)]).encode())
+    for folder in (join(framework_dir, "src"), join(framework_dir, "include")):
+        for path in sorted(_files(folder, {".c", ".cpp", ".S", ".h", ".hpp"})):
+            h.update(f"{path}:{getmtime(path)}\n".encode())
+    key = h.hexdigest()
+    try:
+        with open(cache_path, "r") as f:
+            cached = json.load(f)
+        if cached.get("key") == key:
+            return cached["index"]
+    except (OSError, ValueError):
+        pass
+    index = build_module_index(framework_dir, srcs)
+    try:
+        os.makedirs(dirname(cache_path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=dirname(cache_path))
+        with os.fdopen(fd, "w") as f:
+            json.dump({"key": key, "index": index}, f)
+        os.replace(tmp, cache_path)
+    except OSError:
+        pass
+    return index
+
+
+def scan_identifiers(paths):
+    """ All identifiers in the given files and folders (recursively). """
+    found = set()
+    for path in paths:
+        files = _files(path, USER_EXTENSIONS) if isdir(path) else [path]
+        for f in files:
+            found.update(n.decode() for n in IDENTIFIER.findall(_read(f)))
+    return found
+
+
+def close_modules(index, needed):
+    """ Add the modules the needed ones depend on, until nothing changes. """
+    provides = {m: set(entry["provides"]) for m, entry in index.items()}
+    needed = (set(needed) | {CORE}) & set(index)
+    pending = list(needed)
+    while pending:
+        uses = set(index[pending.pop()]["uses"])
+        for module, names in provides.items():
+            if module not in needed and names & uses:
+                needed.add(module)
+                pending.append(module)
+    return needed
+
+
+def detect_modules(index, user_identifiers):
+    """ The modules the project's sources need, including indirect dependencies. """
+    direct = {m for m, entry in index.items() if user_identifiers & set(entry["provides"])}
+    return close_modules(index, direct)
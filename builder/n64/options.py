@@ -0,0 +1,55 @@
+# Copyright 2024-present Maximilian Gerhardt <maximilian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Parsing of the custom_* options from platformio.ini
+#
+
+import re
+
+SIZE_UNITS = {"": 1, "B": 1, "K": 1024, "KB": 1024, "M": 1024 ** 2, "MB": 1024 ** 2,
+              "G": 1024 ** 3, "GB": 1024 ** 3}
+
+
+def get_bool_option(env, name, default=False):
+    value = str(env.GetProjectOption(name, "")).strip().lower()
+    if not value:
+        return default
+    return value in ("yes", "true", "1", "on")
+
+
+def parse_size(value):
+    """ Parse a size like "4096", "512K", "8MB" or "2 GB" into bytes. """
+    m = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMG]?B?)\s*$", str(value), re.IGNORECASE)
+    if not m:
+        raise ValueError(f"Invalid size '{value}'")
+    return int(float(m.group(1)) * SIZE_UNITS[m.group(2).upper()])
+
+
+def get_size_option(env, name, default):
+    value = str(env.GetProjectOption(name, "")).strip()
+    return parse_size(value) if value else default
+
+
+def get_list_option(env, name):
+    """ Split a multi-line (or comma separated) option into a list of values. """
+    value = str(env.GetProjectOption(name, ""))
+    return [item.strip() for item in re.split(r"[,\n]", value) if item.strip()]
+
+
+def get_list_of_lists_option(env, name):
+    """ A multi-line option with one list per line, its values separated by commas or spaces. """
+    value = str(env.GetProjectOption(name, ""))
+    lists = [[item for item in re.split(r"[,\s]+", line) if item] for line in value.splitlines()]
+    return [items for items in lists if items]
@@ -0,0 +1,213 @@
+# Copyright 2024-present Maximilian Gerhardt <maximilian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# ROM assembly from a declarative layout.
+#
+# The layout is a list of segments (the compressed ELF, symbol files, the DFS image,
+# extra blobs), each one aligned in the ROM. A full ROM is always written by n64tool,
+# which also writes the header, IPL3 and the table of contents. Afterwards the offset
+# of every segment is read back from that TOC, and together with the space it may use
+# (up to the next segment or the TOC) remembered next to the ROM. If the TOC can't be
+# read or doesn't match the files, nothing is remembered and every build runs n64tool.
+#
+# When the layout stays the same and only the contents of some segments changed,
+# those are patched in place through a memory-mapped file, as long as they still
+# fit. The TOC only holds offsets, so it stays valid; the IPL3 checksum doesn't
+# cover anything behind the IPL3.
+#
+
+import json
+import mmap
+import struct
+from os import remove, replace, stat
+from os.path import basename, isfile
+
+from .trace import span
+
+TOC_MAGIC = b"TOC0"
+# rompak TOC header (big endian): magic, TOC size, entry size, number of entries.
+# Every entry starts with the ROM offset of its file, followed by the file name.
+TOC_HEADER = struct.Struct(">4sIII")
+# header + IPL3, n64tool places the first file behind it
+ROM_HEADER_SIZE = 0x1000
+# n64tool only keeps 20 characters of the title
+TITLE_LENGTH = 20
+
+STATE_VERSION = 2
+
+
+def rom_title(title):
+    """ Header title as n64tool stores it: printable ASCII, at most 20 characters. """
+    # no quotes or $ either, the title ends up in an SCons command line
+    title = "".join(c for c in str(title) if 32 <= ord(c) < 127 and c not in '"$')
+    return title[:TITLE_LENGTH]
+
+
+def rom_layout_key(title, layout, end_align):
+    """ Everything but the segment contents that decides how n64tool lays out the ROM. """
+    return json.dumps([title, [[basename(path), align] for path, align in layout], end_align])
+
+
+def n64tool_command(title, layout, end_align, output):
+    """ The n64tool invocation writing the whole ROM. """
+    cmd = ['"$N64TOOL"', "--title", '"%s"' % title, "--toc", "--output", '"%s"' % output]
+    for path, align in layout:
+        cmd += ["--align", str(align), '"%s"' % path]
+    if end_align:
+        cmd += ["--align", str(end_align)]
+    return " ".join(cmd)
+
+
+def read_toc(buf):
+    """
+    The rompak TOC n64tool writes with --toc, as (offset, size, [entry offsets]), or None.
+    Only accepted if the header is consistent, anything else isn't patched in place.
+    """
+    toc = buf.find(TOC_MAGIC, ROM_HEADER_SIZE)
+    while 0 <= toc <= len(buf) - TOC_HEADER.size:
+        _, toc_size, entry_size, count = TOC_HEADER.unpack_from(buf, toc)
+        if 4 < entry_size and TOC_HEADER.size + count * entry_size <= toc_size <= len(buf) - toc:
+            first = toc + TOC_HEADER.size
+            return toc, toc_size, [struct.unpack_from(">I", buf, first + i * entry_size)[0]
+                                   for i in range(count)]
+        toc = buf.find(TOC_MAGIC, toc + 1)
+    return None
+
+
+def locate_segments(buf, layout):
+    """
+    Find the segments in a ROM written by n64tool through the offsets in its TOC. Every
+    TOC entry has to hold the contents of its file at the file's alignment.
+    Returns a list of {"offset", "size", "slot", "pad"} or None.
+    """
+    toc = read_toc(buf)
+    if toc is None:
+        return None
+    toc_offset, toc_size, offsets = toc
+    if len(offsets) != len(layout):
+        return None
+    segments = []
+    for (path, align), offset in zip(layout, offsets):
+        with open(path, "rb") as f:
+            data = f.read()
+        if offset % align or offset + len(data) > len(buf) or buf[offset:offset + len(data)] != data:
+            return None
+        segments.append({"offset": offset, "size": len(data)})
+
+    # a segment may grow until the next segment, the TOC or the end of the ROM
+    structures = [s["offset"] for s in segments] + [toc_offset, len(buf)]
+    for s in segments:
+        end = s["offset"] + s["size"]
+        if toc_offset < end and s["offset"] < toc_offset + toc_size:
+            return None
+        s["slot"] = min(o for o in structures if o >= end) - s["offset"]
+        # what n64tool pads with (if there is any padding)
+        s["pad"] = buf[end] if s["slot"] > s["size"] else 0
+    return segments
+
+
+def patch_rom(rom_path, segments, changed):
+    """
+    Write the new contents of the changed segments ({index: path}) into the ROM.
+    Returns False, leaving the ROM untouched, if one of them doesn't fit anymore.
+    """
+    patches = []
+    for index, path in changed.items():
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) > segments[index]["slot"]:
+            return False
+        patches.append((segments[index], data))
+    with open(rom_path, "r+b") as fp:
+        with mmap.mmap(fp.fileno(), 0) as mm:
+            for segment, data in patches:
+                offset, slot = segment["offset"], segment["slot"]
+                mm[offset:offset + len(data)] = data
+                mm[offset + len(data):offset + slot] = bytes([segment["pad"]]) * (slot - len(data))
+                segment["size"] = len(data)
+            mm.flush()
+    return True
+
+
+def _load_state(path):
+    if isfile(path):
+        try:
+            with open(path, "r") as f:
+                state = json.load(f)
+            if state.get("version") == STATE_VERSION:
+                return state
+        except (OSError, ValueError):
+            pass
+    return None
+
+
+def _save_state(path, state):
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    replace(path + ".tmp", path)
+
+
+def build_rom(target, source, env):
+    """
+    ElfToZ64 action: patch the changed segments of the existing ROM if possible,
+    otherwise write it with n64tool. The alignment of every source is in N64_ROM_ALIGN.
+    """
+    with span("ElfToZ64 " + target[0].name, "action"):
+        return _build_rom(target, source, env)
+
+
+def _build_rom(target, source, env):
+    rom = target[0].get_abspath()
+    state_path = rom + ".layout.json"
+    title = rom_title(env.get("N64_ROM_TITLE", ""))
+    end_align = int(env.get("N64_ROM_END_ALIGN", 0))
+    layout = [(s.get_abspath(), int(align)) for s, align in zip(source, env["N64_ROM_ALIGN"])]
+    key = rom_layout_key(title, layout, end_align)
+    signatures = [s.get_csig() for s in source]
+
+    state = _load_state(state_path)
+    if state and state["key"] == key and isfile(rom):
+        st = stat(rom)
+        if state["rom"] == [st.st_size, st.st_mtime_ns]:
+            changed = {i: layout[i][0] for i, csig in enumerate(signatures)
+                       if state["signatures"][i] != csig}
+            if not changed:
+                return None
+            segments = state["segments"]
+            if patch_rom(rom, segments, changed):
+                for i in changed:
+                    print(f"Patched {basename(layout[i][0])} in {rom}")
+                st = stat(rom)
+                _save_state(state_path, dict(state, signatures=signatures, segments=segments,
+                                             rom=[st.st_size, st.st_mtime_ns]))
+                return None
+
+    result = env.Execute(env.VerboseAction(
+        n64tool_command(title, layout, end_align, rom), "Building %s" % rom))
+    if result:
+        return result
+    with open(rom, "rb") as fp:
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            segments = locate_segments(mm, layout)
+    if segments is None:
+        # can't tell where n64tool put everything, the next build writes the whole ROM again
+        print(f"No matching TOC in {rom}, it won't be patched in place")
+        if isfile(state_path):
+            remove(state_path)
+        return None
+    st = stat(rom)
+    _save_state(state_path, {"version": STATE_VERSION, "key": key, "signatures": signatures,
+                             "segments": segments, "rom": [st.st_size, st.st_mtime_ns]})
+    return None
@@ -0,0 +1,185 @@
+# Copyright 2024-present Maximilian Gerhardt <maximilian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Size and duplication analysis of the main program and the DSOs.
+#
+# Every function and object symbol of the main ELF and the DSO ELFs is hashed by
+# its contents. DSOs are linked separately, so the same helper or table can end up
+# in several of them (and in the main program), costing ROM and, when they are
+# loaded together, RDRAM.
+#
+# Addresses differ between the copies, so they are masked before hashing:
+# - in DSOs, everything a kept relocation (--emit-relocs) patches;
+# - in the main program, which has no relocations left: j / jal targets, lui of a
+#   KSEG0 address and the immediates of instructions using such a register, and
+#   data words holding a KSEG0 address.
+# Functions whose instructions only differ in these places hash the same.
+#
+
+import hashlib
+import json
+import struct
+from os.path import basename, isfile, splitext
+
+from .elf import SHF_ALLOC, SHF_EXECINSTR, SHT_NOBITS, STT_FUNC, STT_OBJECT, ElfFile
+from .mapfile import AddressIndex, input_sections
+
+MAIN = "main"
+# smaller symbols (stubs like "jr ra; nop") are identical all the time
+MIN_DUPLICATE_SIZE = 16
+KSEG0 = (0x80000000, 0x80800000)
+
+OP_J, OP_JAL, OP_LUI = 0x02, 0x03, 0x0F
+# addiu, daddiu, ori and all loads / stores take the %lo() part of an address
+LO16_OPS = {0x09, 0x19, 0x0D} | set(range(0x20, 0x40))
+
+
+def _mask_code(code, base, relocated):
+    words = list(struct.unpack(">%dI" % (len(code) // 4), code[:len(code) // 4 * 4]))
+    address_regs = set()
+    for i, w in enumerate(words):
+        op = w >> 26
+        if base + i * 4 in relocated:
+            words[i] = w & 0xFC000000 if op in (OP_J, OP_JAL) else w & 0xFFFF0000
+        elif op in (OP_J, OP_JAL):
+            words[i] = w & 0xFC000000
+        elif op == OP_LUI and KSEG0[0] >> 16 <= (w & 0xFFFF) < KSEG0[1] >> 16:
+            address_regs.add((w >> 16) & 0x1F)
+            words[i] = w & 0xFFFF0000
+        elif op in LO16_OPS and (w >> 21) & 0x1F in address_regs:
+            words[i] = w & 0xFFFF0000
+    return struct.pack(">%dI" % len(words), *words)
+
+
+def _mask_data(data, base, relocated):
+    out = bytearray(data)
+    for off in range(0, len(data) - 3, 4):
+        value = struct.unpack_from(">I", data, off)[0]
+        if base + off in relocated or KSEG0[0] <= value < KSEG0[1]:
+            out[off:off + 4] = bytes(4)
+    return bytes(out)
+
+
+def elf_symbols(path, module, map_path=None):
+    """ The function and object symbols of an ELF as a list of dicts, with a masked content hash. """
+    elf = ElfFile.read(path)
+    relocated = elf.relocation_addresses()
+    origins = AddressIndex(input_sections(map_path)) if map_path and isfile(map_path) else None
+    result = []
+    seen = set()
+    for sym in elf.symbols:
+        if sym.type not in (STT_FUNC, STT_OBJECT) or not sym.size or sym.shndx >= len(elf.sections):
+            continue
+        section = elf.sections[sym.shndx]
+        if not section.flags & SHF_ALLOC or (sym.name, sym.value) in seen:
+            continue
+        seen.add((sym.name, sym.value))
+        kind = "code" if section.flags & SHF_EXECINSTR else "bss" if section.type == SHT_NOBITS else "data"
+        entry = {"module": module, "name": sym.name, "section": section.name, "kind": kind,
+                 "size": sym.size, "global": sym.bind != 0, "hash": None}
+        if kind != "bss":
+            start = section.offset + sym.value - section.addr
+            content = elf.data[start:start + sym.size]
+            masked = _mask_code(content, sym.value, relocated) if kind == "code" else \
+                _mask_data(content, sym.value, relocated)
+            entry["hash"] = hashlib.sha1(masked).hexdigest()
+        if origins is not None:
+            origin = origins.find(sym.value)
+            entry["file"] = basename(origin.file) if origin else None
+        result.append(entry)
+    return result
+
+
+def find_duplicates(symbols):
+    """ Groups of symbols with the same kind, size and masked contents in more than one place. """
+    groups = {}
+    for s in symbols:
+        if s["hash"] and s["size"] >= MIN_DUPLICATE_SIZE:
+            groups.setdefault((s["kind"], s["size"], s["hash"]), []).append(s)
+    duplicates = []
+    for (kind, size, h), members in groups.items():
+        if len(members) < 2:
+            continue
+        modules = sorted({m["module"] for m in members})
+        if MAIN in modules and len(modules) > 1:
+            advice = "use the main program's copy in the DSOs"
+        elif MAIN not in modules and len(modules) > 1:
+            advice = "move into the main program"
+        else:
+            advice = "identical code / data within %s" % modules[0]
+        duplicates.append({
+            "kind": kind, "size": size, "hash": h,
+            "names": sorted({m["name"] for m in members}), "modules": modules,
+            "copies": len(members), "wasted": size * (len(members) - 1), "advice": advice,
+        })
+    return sorted(duplicates, key=lambda d: (-d["wasted"], d["names"][0]))
+
+
+def module_totals(symbols):
+    totals = {}
+    for s in symbols:
+        t = totals.setdefault(s["module"], {"code": 0, "data": 0, "bss": 0, "symbols": 0})
+        t[s["kind"]] += s["size"]
+        t["symbols"] += 1
+    return totals
+
+
+def analyze(main_elf, main_map, dso_elfs):
+    symbols = elf_symbols(main_elf, MAIN, main_map)
+    for dso in dso_elfs:
+        symbols += elf_symbols(dso, splitext(basename(dso))[0])
+    duplicates = find_duplicates(symbols)
+    return {
+        "modules": module_totals(symbols),
+        "duplicates": duplicates,
+        # only what is duplicated across modules can be shared by moving it
+        "candidates": [d for d in duplicates if len(d["modules"]) > 1],
+        "symbols": sorted(symbols, key=lambda s: (-s["size"], s["module"], s["name"])),
+    }
+
+
+def print_report(report, top_n=20):
+    print(f"{'module':<20} {'code':>10} {'data':>10} {'bss':>10} {'symbols':>8}")
+    for module, t in sorted(report["modules"].items(), key=lambda m: (m[0] != MAIN, m[0])):
+        print(f"{module:<20} {t['code']:>10} {t['data']:>10} {t['bss']:>10} {t['symbols']:>8}")
+
+    duplicates = report["duplicates"]
+    print(f"\n{len(duplicates)} duplicated symbols, {sum(d['wasted'] for d in duplicates)} bytes in extra copies")
+    if duplicates:
+        print(f"{'wasted':>8} {'size':>8} {'kind':<5} {'copies':>6}  symbol / modules")
+        for d in duplicates[:top_n]:
+            names = ", ".join(d["names"][:3]) + (" ..." if len(d["names"]) > 3 else "")
+            print(f"{d['wasted']:>8} {d['size']:>8} {d['kind']:<5} {d['copies']:>6}  {names} "
+                  f"({', '.join(d['modules'])})")
+
+    candidates = report["candidates"]
+    if candidates:
+        print("\nCandidates to share:")
+        for d in candidates[:top_n]:
+            print(f"  {', '.join(d['names'][:3])}: {d['advice']} (saves {d['wasted']} bytes)")
+
+
+def size_analysis_action(target, source, env):
+    """
+    Target action. source[0] is the main ELF, the other sources the DSO ELFs.
+    Writes $BUILD_DIR/size_analysis.json and prints a summary.
+    """
+    main_elf = source[0].get_abspath()
+    report = analyze(main_elf, splitext(main_elf)[0] + ".map", [s.get_abspath() for s in source[1:]])
+    out = env.subst("$BUILD_DIR/size_analysis.json")
+    with open(out, "w") as f:
+        json.dump(report, f, indent=1)
+    print_report(report)
+    print(f"\nFull report: {out}")
@@ -0,0 +1,147 @@
+# Copyright 2024-present Maximilian Gerhardt <maximilian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Size report from the linker map: how much .text, .rodata, .data, .bss, ... every
+# archive, object file and symbol contributes to the program.
+#
+# The report of the last `pio run -t sizereport` is kept in $BUILD_DIR, and the
+# next one prints what grew (and shrank) since then, biggest changes first.
+#
+
+import json
+import sys
+from os.path import basename, isfile, relpath
+
+from .mapfile import input_sections
+
+REPORT_VERSION = 1
+CATEGORIES = (".text", ".rodata", ".data", ".sdata", ".bss", ".sbss", ".lit4", ".lit8")
+PROJECT_OBJECTS = "(project)"
+
+
+def section_category(name):
+    """ The output section an input section counts for, or None. """
+    if name == "COMMON":
+        return ".bss"
+    if name == ".scommon":
+        return ".sbss"
+    for category in CATEGORIES:
+        if name == category or name.startswith(category + "."):
+            return category
+    return None
+
+
+def build_size_report(map_path, build_dir=None):
+    """ {"sections", "archives", "objects": {name: {category: size}}, "symbols": {name: [category, size]}} """
+    report = {"version": REPORT_VERSION, "sections": {}, "archives": {}, "objects": {}, "symbols": {}}
+    for section in input_sections(map_path):
+        category = section_category(section.name)
+        if category is None:
+            continue
+        if section.archive:
+            archive = basename(section.archive)
+            obj = f"{archive}({section.object})"
+        else:
+            archive = PROJECT_OBJECTS
+            obj = section.object
+            if build_dir:
+                try:
+                    short = relpath(obj, build_dir).replace("\\", "/")
+                    obj = obj if short.startswith("..") else short
+                except ValueError:
+                    pass
+        report["sections"][category] = report["sections"].get(category, 0) + section.size
+        for level, key in (("archives", archive), ("objects", obj)):
+            sizes = report[level].setdefault(key, {})
+            sizes[category] = sizes.get(category, 0) + section.size
+        for name, size in section.symbol_sizes():
+            # static symbols of the same name in different objects stay apart
+            key = f"{name} [{obj}]"
+            if key not in report["symbols"]:
+                report["symbols"][key] = [category, size]
+    return report
+
+
+def load_report(path):
+    if isfile(path):
+        try:
+            with open(path, "r") as f:
+                report = json.load(f)
+            if report.get("version") == REPORT_VERSION:
+                return report
+        except (OSError, ValueError):
+            pass
+    return None
+
+
+def _total(sizes):
+    return sum(sizes.values()) if isinstance(sizes, dict) else sizes[1]
+
+
+def diff_level(old, new):
+    """ [(name, old size, new size)] of everything that changed, biggest growth first. """
+    changes = []
+    for key in set(old) | set(new):
+        before = _total(old[key]) if key in old else 0
+        after = _total(new[key]) if key in new else 0
+        if before != after:
+            changes.append((key, before, after))
+    return sorted(changes, key=lambda c: (-(c[2] - c[1]), c[0]))
+
+
+def _print_changes(title, changes, top_n):
+    grew = [c for c in changes if c[2] > c[1]][:top_n]
+    shrank = [c for c in reversed(changes) if c[2] < c[1]][:top_n]
+    if not grew and not shrank:
+        return
+    print(f"\n{title}:")
+    for name, before, after in grew + shrank:
+        print(f"  {after - before:>+9} {before:>10} -> {after:<10} {name}")
+
+
+def print_report(report, previous, top_n=15):
+    sections = report["sections"]
+    old_sections = previous["sections"] if previous else {}
+    print(f"{'section':<10} {'size':>10} {'change':>10}")
+    for category in CATEGORIES:
+        if category in sections or category in old_sections:
+            size = sections.get(category, 0)
+            change = size - old_sections.get(category, 0) if previous else 0
+            print(f"{category:<10} {size:>10} {change:>+10}")
+
+    if previous is None:
+        print("\nLargest objects:")
+        for name, sizes in sorted(report["objects"].items(), key=lambda o: -_total(o[1]))[:top_n]:
+            print(f"  {_total(sizes):>10} {name}")
+        print("\nNo earlier report to compare with, the next run shows what changed.")
+        return
+    _print_changes("Archives", diff_level(previous["archives"], report["archives"]), top_n)
+    _print_changes("Objects", diff_level(previous["objects"], report["objects"]), top_n)
+    _print_changes("Symbols", diff_level(previous["symbols"], report["symbols"]), top_n)
+
+
+def sizereport_action(target, source, env):
+    """ Target action: report for $BUILD_DIR/${PROGNAME}.map, compared to the last one. """
+    map_path = env.subst("$BUILD_DIR/${PROGNAME}.map")
+    if not isfile(map_path):
+        sys.stderr.write(f"Error: no linker map {map_path}, the program has to be linked with -Wl,-Map\n")
+        return 1
+    report_path = env.subst("$BUILD_DIR/sizereport.json")
+    previous = load_report(report_path)
+    report = build_size_report(map_path, env.subst("$BUILD_DIR"))
+    print_report(report, previous)
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    return None
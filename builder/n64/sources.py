@@ -0,0 +1,108 @@
+# Copyright 2024-present Maximilian Gerhardt <maximilian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Cached list of the source files of a framework package.
+#
+# Walking the whole framework tree on every build is not free, and the result only
+# changes with the framework revision. The list is kept in a small JSON file in the
+# PlatformIO core folder, keyed by the package version and location. The mtimes of the
+# source folders are checked as well, so new files in a development checkout are found.
+#
+# folders_signature() turns the folder mtimes into a key for development checkouts.
+#
+
+import hashlib
+import json
+import os
+import tempfile
+from os.path import dirname, getmtime, isdir, join, relpath
+
+SCAN_VERSION = 1
+MAX_ENTRIES = 16
+# entries found by find_framework_sources() in this build, by key
+_entries = {}
+
+
+def scan_sources(src_dir, extensions):
+    """
+    All files with one of the extensions below src_dir, as sorted '/' separated relative
+    paths, and the {folder: mtime} of every folder that was visited.
+    """
+    found = []
+    folders = {}
+    for root, dirs, files in os.walk(src_dir):
+        folders[root] = getmtime(root)
+        for name in files:
+            if os.path.splitext(name)[1] in extensions:
+                found.append(relpath(join(root, name), src_dir).replace(os.sep, "/"))
+    return sorted(found), folders
+
+
+def _is_current(entry, extensions):
+    # a folder's mtime changes when files are added, removed or renamed in it,
+    # so stat'ing the known folders is enough, no need to list them again
+    if entry is None or entry["extensions"] != sorted(extensions):
+        return False
+    try:
+        return all(getmtime(folder) == mtime for folder, mtime in entry["folders"].items())
+    except OSError:
+        return False
+
+
+def _entry_key(revision, src_dir):
+    return hashlib.sha256(json.dumps([SCAN_VERSION, revision, src_dir]).encode()).hexdigest()
+
+
+def find_framework_sources(src_dir, extensions, revision, cache_path):
+    """ scan_sources(), remembered in cache_path per framework revision. """
+    if not isdir(src_dir):
+        return []
+    key = _entry_key(revision, src_dir)
+    try:
+        with open(cache_path, "r") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = {}
+    entry = cached.get(key)
+    if _is_current(entry, extensions):
+        _entries[key] = entry
+        return entry["sources"]
+    sources, folders = scan_sources(src_dir, extensions)
+    # keep a few revisions around, several projects may use different frameworks
+    cached.pop(key, None)
+    cached = dict(list(cached.items())[-(MAX_ENTRIES - 1):])
+    cached[key] = _entries[key] = {"extensions": sorted(extensions), "folders": folders, "sources": sources}
+    try:
+        os.makedirs(dirname(cache_path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=dirname(cache_path))
+        with os.fdopen(fd, "w") as f:
+            json.dump(cached, f)
+        os.replace(tmp, cache_path)
+    except OSError:
+        pass
+    return sources
+
+
+
+def folders_signature(src_dir, revision, cache_path):
+    """
+    Hash of the folder mtimes find_framework_sources() recorded for src_dir, relative to
+    it. For development checkouts, whose revision doesn't change with edits.
+    """
+    entry = _entries.get(_entry_key(revision, src_dir))
+    folders = entry["folders"] if entry else scan_sources(src_dir, ())[1]
+    return hashlib.sha256(json.dumps(sorted(
+        (relpath(folder, src_dir).replace(os.sep, "/"), mtime) for folder, mtime in folders.items()
+    )).encode()).hexdigest()
@@ -0,0 +1,133 @@
+# Copyright 2024-present Maximilian Gerhardt <maximilian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Build timeline in the Chrome trace event format (chrome://tracing, ui.perfetto.dev).
+#
+# Enabled with `custom_build_trace = path.json`. Every process SCons spawns is
+# recorded through a wrapped SPAWN function, the Python build steps add their own
+# spans via span(). When SCons exits, the trace is written and the slowest steps
+# are printed.
+#
+
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from os.path import basename, getmtime, getsize, isabs, isfile, join
+
+_tracer = None
+
+
+class BuildTrace:
+
+    def __init__(self, path, top_n=15):
+        self.path = path
+        self.top_n = top_n
+        self.events = []
+        self._lock = threading.Lock()
+        self._lanes = {}
+        self._start = time.perf_counter()
+
+    def _now(self):
+        return (time.perf_counter() - self._start) * 1e6  # microseconds
+
+    def _lane(self):
+        ident = threading.get_ident()
+        with self._lock:
+            return self._lanes.setdefault(ident, len(self._lanes) + 1)
+
+    def add(self, name, category, start, end, args=None):
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round(start, 1),
+            "dur": round(end - start, 1),
+            "pid": os.getpid(),
+            "tid": self._lane(),
+            "args": args or {},
+        }
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, category="action", **args):
+        start = self._now()
+        try:
+            yield args  # callers may add more details while the span runs
+        finally:
+            self.add(name, category, start, self._now(), args)
+
+    def wrap_spawn(self, spawn):
+        """ Wrap SCons' SPAWN function to record every command it runs. """
+        def traced_spawn(sh, escape, cmd, args, env):
+            files = [a.strip('"') for a in args[1:]]
+            before = {}
+            for f in files:
+                if isfile(f):
+                    before[f] = getmtime(f)
+            start = self._now()
+            result = spawn(sh, escape, cmd, args, env)
+            end = self._now()
+            outputs = [f for f in files if isfile(f) and (f not in before or getmtime(f) != before[f])]
+            inputs = [f for f in before if f not in outputs]
+            command = " ".join(args)
+            self.add(basename(outputs[0]) if outputs else basename(str(cmd)), "spawn", start, end, {
+                "cmd": command if len(command) < 4096 else command[:4096] + "...",
+                "exit_code": result,
+                "in_bytes": sum(getsize(f) for f in inputs),
+                "out_bytes": sum(getsize(f) for f in outputs),
+                "outputs": outputs,
+            })
+            return result
+        return traced_spawn
+
+    def summary(self):
+        slowest = sorted(self.events, key=lambda e: e["dur"], reverse=True)[:self.top_n]
+        total = self._now() / 1e6
+        print(f"Build trace written to {self.path} ({len(self.events)} events, {total:.1f} s)")
+        print(f"Slowest {len(slowest)} steps:")
+        for e in slowest:
+            print(f"  {e['dur'] / 1e6:8.2f} s  [{e['cat']}] {e['name']}")
+
+    def write(self):
+        with self._lock:
+            events = sorted(self.events, key=lambda e: e["ts"])
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        self.summary()
+
+
+def enable_build_trace(env, path):
+    """ Start recording, the trace is written when SCons exits. """
+    global _tracer
+    if not isabs(path):
+        path = join(env.subst("$PROJECT_DIR"), path)
+    _tracer = BuildTrace(path)
+    env["SPAWN"] = _tracer.wrap_spawn(env["SPAWN"])
+    atexit.register(_tracer.write)
+    return _tracer
+
+
+@contextmanager
+def span(name, category="action", **args):
+    """ Record a build step. Does nothing unless custom_build_trace is set. """
+    if _tracer is None:
+        yield args
+        return
+    with _tracer.span(name, category, **args) as span_args:
+        yield span_args
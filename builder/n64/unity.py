@@ -0,0 +1,62 @@
+# Copyright 2024-present Maximilian Gerhardt <maximilian.gerhardt@rub.de>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Unity ("jumbo") translation units: all C files of one module are #included into
+# a single generated file, so that the common headers are only parsed once per
+# module instead of once per file.
+#
+
+from fnmatch import fnmatch
+from os import makedirs
+from os.path import dirname, isfile
+from pathlib import PurePosixPath
+
+UNITY_HEADER = "/* Generated by the nintendon64 platform (unity build), do not edit. */\n"
+
+
+def group_unity_sources(srcs, exclude=()):
+    """
+    Split sources into {module: [C files]} and the files that are built on their own.
+    A module is a top-level folder of the source tree, files directly in it, C++ and
+    assembly files and everything matching one of the `exclude` patterns stay separate,
+    as do modules that would only consist of one file.
+    """
+    units = {}
+    separate = []
+    for src in srcs:
+        path = PurePosixPath(src.replace("\\", "/"))
+        if (path.suffix != ".c" or len(path.parts) < 2
+                or any(fnmatch(path.as_posix(), pattern) for pattern in exclude)):
+            separate.append(src)
+            continue
+        units.setdefault(path.parts[0], []).append(src)
+    for module, files in list(units.items()):
+        if len(files) < 2:
+            separate.extend(files)
+            del units[module]
+    return {module: sorted(files) for module, files in units.items()}, sorted(separate)
+
+
+def write_unity_source(path, includes):
+    """ Write the unity file, leaving it untouched if the contents did not change. """
+    contents = UNITY_HEADER + "".join('#include "%s"\n' % inc.replace("\\", "/") for inc in includes)
+    if isfile(path):
+        with open(path, "r") as f:
+            if f.read() == contents:
+                return False
+    makedirs(dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(contents)
+    return True
@@ -0,0 +1,198 @@
+"""
+Compare build variants of a PlatformIO project using this platform.
+
+Every variant is a set of options that is added to the environment in platformio.ini
+(e.g. custom_libdragon_unity = yes). Each variant gets its own build folder and is
+built from scratch, then once more without changes. Reported are the wall time of
+both builds, the ROM size and the section sizes of the linked ELF.
+
+Runtime speed can only be measured by running the ROM. If the environment has
+`custom_bench_rom_cmd` set (or --rom-cmd is given), that command is run for every
+variant with {rom} replaced by the path of the ROM, e.g. an emulator in a benchmark
+mode. The last line it prints is reported (for example the average frame time).
+Otherwise the ROMs are kept in the variants' build folders for testing by hand.
+
+    python bench_build.py path/to/project -e env_name \
+        -v regular: \
+        -v unity:custom_libdragon_unity=yes \
+        --json results.json
+
+Several projects can be given (e.g. examples/*), each one is built in all variants
+and the totals are compared at the end. Without -e, the first environment of every
+project is used.
+"""
+
+import argparse
+import configparser
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "builder"))
+from n64.elf import ElfFile, SHF_ALLOC, SHT_NOBITS  # noqa: E402
+
+# caches would turn the "clean" build into a cache restore
+DEFAULT_OPTIONS = {
+    "custom_libdragon_cache": "no",
+    "custom_compiler_cache": "no",
+}
+
+
+def parse_variant(text):
+    """ "name:opt=value,opt=value" -> (name, {opt: value}) """
+    name, _, options = text.partition(":")
+    result = {}
+    for option in filter(None, (o.strip() for o in options.split(","))):
+        key, _, value = option.partition("=")
+        result[key.strip()] = value.strip()
+    return name.strip(), result
+
+
+def write_project_conf(project_dir, env_name, name, options):
+    config = configparser.ConfigParser(interpolation=None)
+    config.optionxform = str
+    config.read(os.path.join(project_dir, "platformio.ini"))
+    if env_name is None:
+        env_name = next((s[4:] for s in config.sections() if s.startswith("env:")), "")
+    section = "env:" + env_name
+    if not config.has_section(section):
+        raise SystemExit(f"No [{section}] in {project_dir}/platformio.ini")
+    for key, value in {**DEFAULT_OPTIONS, **options}.items():
+        config.set(section, key, value)
+    if not config.has_section("platformio"):
+        config.add_section("platformio")
+    build_dir = os.path.join(project_dir, ".pio", "bench", name)
+    config.set("platformio", "build_dir", build_dir)
+    path = os.path.join(project_dir, f".bench_{name}.ini")
+    with open(path, "w") as f:
+        config.write(f)
+    rom_cmd = config.get(section, "custom_bench_rom_cmd", fallback="").strip()
+    return path, env_name, os.path.join(build_dir, env_name), rom_cmd
+
+
+def run_rom_cmd(command, rom):
+    result = subprocess.run(command.replace("{rom}", '"%s"' % rom), shell=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    lines = [line.strip() for line in result.stdout.splitlines() if line.strip()]
+    if result.returncode:
+        return "failed (exit code %d)" % result.returncode
+    return lines[-1] if lines else ""
+
+
+def timed_build(project_dir, project_conf, env_name, verbose):
+    start = time.perf_counter()
+    result = subprocess.run(
+        # pio itself is often not on PATH when started from an IDE or PlatformIO's penv
+        [sys.executable, "-m", "platformio", "run", "-d", project_dir, "-c", project_conf, "-e", env_name],
+        stdout=None if verbose else subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode:
+        if not verbose:
+            print(result.stdout[-4000:])
+        raise SystemExit(f"Build failed ({project_conf})")
+    return elapsed
+
+
+def section_sizes(elf_path):
+    elf = ElfFile.read(elf_path)
+    sizes = {}
+    for s in elf.sections:
+        if s.flags & SHF_ALLOC and s.size:
+            key = "bss" if s.type == SHT_NOBITS else s.name.lstrip(".")
+            sizes[key] = sizes.get(key, 0) + s.size
+    return sizes
+
+
+def find_output(build_dir, ext):
+    for name in ("firmware", "program"):
+        path = os.path.join(build_dir, name + ext)
+        if os.path.isfile(path):
+            return path
+    candidates = [f for f in os.listdir(build_dir) if f.endswith(ext)]
+    return os.path.join(build_dir, candidates[0]) if candidates else None
+
+
+def run_variant(args, project, name, options):
+    project_conf, env_name, build_dir, rom_cmd = write_project_conf(project, args.environment, name, options)
+    rom_cmd = args.rom_cmd or rom_cmd
+    try:
+        result = {"project": os.path.basename(project), "variant": name, "options": options}
+        times = []
+        for _ in range(args.runs):
+            shutil.rmtree(build_dir, ignore_errors=True)
+            times.append(timed_build(project, project_conf, env_name, args.verbose))
+        result["clean_build_s"] = min(times)
+        result["noop_build_s"] = timed_build(project, project_conf, env_name, args.verbose)
+        rom = find_output(build_dir, ".z64")
+        elf = find_output(build_dir, ".elf")
+        result["rom_bytes"] = os.path.getsize(rom) if rom else None
+        result["sections"] = section_sizes(elf) if elf else {}
+        result["rom_cmd"] = run_rom_cmd(rom_cmd, rom) if rom_cmd and rom else None
+        result["build_dir"] = build_dir
+        return result
+    finally:
+        os.remove(project_conf)
+
+
+def print_table(results):
+    columns = ["text", "data", "rodata", "bss"]
+    print(f"== {results[0]['project']}")
+    header = f"{'variant':<20} {'clean [s]':>10} {'no-op [s]':>10} {'ROM':>10} " + \
+        " ".join(f"{c:>10}" for c in columns)
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['variant']:<20} {r['clean_build_s']:>10.1f} {r['noop_build_s']:>10.1f} "
+              f"{r['rom_bytes'] or 0:>10} " +
+              " ".join(f"{r['sections'].get(c, 0):>10}" for c in columns) +
+              (f"  {r['rom_cmd']}" if r["rom_cmd"] is not None else ""))
+    if len(results) > 1:
+        base = results[0]
+        print(f"\nrelative to '{base['variant']}':")
+        for r in results[1:]:
+            print(f"  {r['variant']}: clean build {r['clean_build_s'] / base['clean_build_s'] * 100 - 100:+.1f} %, "
+                  f"ROM {(r['rom_bytes'] or 0) - (base['rom_bytes'] or 0):+d} bytes, "
+                  f".text {r['sections'].get('text', 0) - base['sections'].get('text', 0):+d} bytes")
+
+
+def print_totals(results, variants):
+    print("== total over %d projects" % len({r["project"] for r in results}))
+    base = None
+    for name in variants:
+        clean = sum(r["clean_build_s"] for r in results if r["variant"] == name)
+        base = clean if base is None else base
+        print(f"{name:<20} clean builds {clean:>8.1f} s ({clean / base * 100 - 100:+.1f} %)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("projects", nargs="+", help="PlatformIO project folders")
+    parser.add_argument("-e", "--environment", help="default: the first one of each project")
+    parser.add_argument("-v", "--variant", action="append", required=True,
+                        help="name:option=value,... (the first one is the baseline)")
+    parser.add_argument("--runs", type=int, default=1, help="clean builds per variant, the fastest counts")
+    parser.add_argument("--rom-cmd", help="run for every ROM, {rom} is replaced by its path")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the build output")
+    args = parser.parse_args()
+
+    variants = [parse_variant(v) for v in args.variant]
+    results = []
+    for project in args.projects:
+        project_results = [run_variant(args, os.path.abspath(project), name, options)
+                           for name, options in variants]
+        print_table(project_results)
+        print()
+        results.extend(project_results)
+    if len(args.projects) > 1:
+        print_totals(results, [name for name, _ in variants])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()